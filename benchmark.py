@@ -0,0 +1,268 @@
+# Measures the throughput and the precision of the solver: runs the reference
+# drivers of all the races and the long-running solver self test workloads
+# with every integrator and a few time steps, and saves the results as JSON to
+# compare before and after a change.
+#
+# Usage:
+#   python benchmark.py [--output benchmark.json] [--workloads race_01,pendulum]
+#                       [--integrators rk4,yoshida4] [--step-multipliers 1,2]
+#                       [--reference-divisor 4]
+#
+# For each run, it reports:
+#   steps_per_second, driver_calls_per_second: for the races, the driver is
+#     my_driver_algorithm; for the self test workloads, it's the accelerations
+#     function.
+#   peak_memory_kb: the peak resident memory of the process doing the run.
+#   error: for the races, the difference between the lap time and the lap time
+#     with RK4 and a reference_divisor times smaller time step. For the self
+#     test workloads, the biggest difference from the precise solution.
+#   final_state: the positions and velocities at the end. rk4, rk4_unrolled
+#     and rk4_in_place must agree on it exactly, see RK4_VARIANTS.
+#
+# Every run happens in a separate process, so that the races start from a
+# clean state and the peak memory only covers that run.
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import math
+import platform
+import subprocess
+import sys
+import time as time_module
+
+import solver
+
+# workload: time step; the duration is the TIME_LIMIT of the race, the initial
+# state comes from its RaceSession.
+RACES = {
+    "race_01": 0.001,
+    "race_02": 0.001,
+    "race_03": 0.0001,
+    "race_04": 0.0001,
+    "race_05": 0.0001,
+    "race_06": 0.0001,
+}
+
+# Same as test_pendulum and test_pendulum_2D in solver.py: 314k steps each.
+# workload: (initial positions, initial velocities, accelerations, precise
+# solution (positions, velocities) at t, duration, time step).
+SELF_TEST_WORKLOADS = {
+    "pendulum": ([1], [0], lambda p, v, t: [-p[0]],
+                 lambda t: ([math.cos(t)], [-math.sin(t)]), 314.1593, 0.001),
+    "pendulum_2D": ([1, 1], [0, 0], lambda p, v, t: [-p[0], -4 * p[1]],
+                    lambda t: ([math.cos(t), math.cos(2 * t)], [-math.sin(t), -2 * math.sin(2 * t)]), 314.1593, 0.001),
+}
+
+INTEGRATORS = ["euler", "rk4", "rk4_unrolled", "rk4_in_place", "velocity_verlet", "yoshida4", "rk45"]
+# These have the same arithmetic, so they must end in exactly the same state.
+# A run that doesn't match the first of them that ran is reported as a failure
+# instead of with its numbers, which would be measured on a broken integrator.
+# (The lap times alone don't show it: they only change by whole steps.)
+RK4_VARIANTS = ["rk4", "rk4_unrolled", "rk4_in_place"]
+
+def solve(integrator, initial_positions, initial_velocities, calculate_accelerations_p_v_t, duration, time_step, progress_listener_callback_p_v_t,
+          step_records = False, observers = None, events = None):
+    # Runs the simulation with the given integrator. With step_records, the
+    # accelerations function returns (accelerations, aux) and the listener
+    # and the observers take a solver.StepRecord, like in races 03-06.
+    if integrator == "rk45":
+        # solveRK45 doesn't do step records and observers, so do them here.
+        make_step_record_p_v_t = None
+        if step_records:
+            calculate_accelerations_and_aux_p_v_t = calculate_accelerations_p_v_t
+            calculate_accelerations_p_v_t = lambda p, v, t: calculate_accelerations_and_aux_p_v_t(p, v, t)[0]
+            make_step_record_p_v_t = lambda p, v, t: solver.StepRecord(p, v, t, *calculate_accelerations_and_aux_p_v_t(p, v, t))
+        progress_listener_callback_p_v_t = solver.makeObserversListener(progress_listener_callback_p_v_t, observers or [], make_step_record_p_v_t)
+        return solver.solveRK45(initial_positions, initial_velocities, calculate_accelerations_p_v_t, duration, time_step, progress_listener_callback_p_v_t,
+                                max_time_step = 10 * time_step, events = events)
+
+    dimension = len(initial_positions)
+    in_place = False
+    if integrator == "euler":
+        solver_function = solver.calculateNextStateEuler
+    elif integrator == "rk4":
+        solver_function = solver.calculateNextStateRK4
+    elif integrator == "rk4_unrolled":
+        solver_function = solver.getUnrolledNextStateFunction("rk4", dimension)
+    elif integrator == "rk4_in_place":
+        solver_function = solver.makeNextStateRK4InPlace(dimension)
+        in_place = True
+    elif integrator == "velocity_verlet":
+        solver_function = solver.makeNextStateVelocityVerlet()
+    elif integrator == "yoshida4":
+        solver_function = solver.calculateNextStateYoshida4
+    else:
+        raise Exception(f"Unknown integrator: {integrator}")
+    return solver.solveGeneric(initial_positions, initial_velocities, calculate_accelerations_p_v_t, duration, time_step, solver_function,
+                               progress_listener_callback_p_v_t, events, in_place = in_place, step_records = step_records, accelerations_aux = step_records,
+                               observers = observers)
+
+def run_race(name, integrator, time_step, locate_finish = False):
+    # Returns (lap time or None for a DNF, number of steps, number of driver
+    # calls, final positions + velocities). The race's own output is hidden.
+    # With locate_finish, the lap time is where the car crosses the finish
+    # within the last step (see make_finish_event in the races) rather than
+    # the end of that step.
+    race = importlib.import_module(name)
+    session = race.RaceSession()
+
+    num_driver_calls = 0
+    driver = session.driver_algorithm
+    def counting_driver(*args):
+        nonlocal num_driver_calls
+        num_driver_calls += 1
+        return driver(*args)
+    session.driver_algorithm = counting_driver
+
+    num_listener_calls = 0
+    step_records = hasattr(session, "progress_listener_callback_step")
+    listener = session.progress_listener_callback_step if step_records else session.progress_listener_callback_p_v_t
+    def counting_listener(*args):
+        nonlocal num_listener_calls
+        num_listener_calls += 1
+        return listener(*args)
+    calculate_accelerations_p_v_t = session.calculate_accelerations_and_driver_input_p_v_t if step_records else session.calculate_accelerations_p_v_t
+    observers = [solver.Observer(session.log_data_step, period = race.DATA_LOG_PERIOD)] if hasattr(session, "log_data_step") else None
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        positions, velocities, time = solve(integrator, session.initial_positions, session.initial_velocities, calculate_accelerations_p_v_t,
+                                            race.TIME_LIMIT, time_step, counting_listener, step_records, observers,
+                                            [race.make_finish_event()] if locate_finish else None)
+    lap_time = time if time < race.TIME_LIMIT else None
+    return lap_time, num_listener_calls - 1, num_driver_calls, positions + velocities
+
+def run_self_test_workload(name, integrator, time_step):
+    # Returns (error, number of steps, number of accelerations function calls,
+    # final positions + velocities).
+    initial_positions, initial_velocities, calculate_accelerations_p_v_t, precise_solution_t, duration, _ = SELF_TEST_WORKLOADS[name]
+
+    num_calls = 0
+    def counting_accelerations_p_v_t(p, v, t):
+        nonlocal num_calls
+        num_calls += 1
+        return calculate_accelerations_p_v_t(p, v, t)
+
+    num_steps = 0
+    def counting_listener(p, v, t):
+        nonlocal num_steps
+        num_steps += 1
+        return False
+
+    positions, velocities, time = solve(integrator, initial_positions, initial_velocities, counting_accelerations_p_v_t, duration, time_step, counting_listener)
+    precise_positions, precise_velocities = precise_solution_t(time)
+    error = max(abs(a - b) for a, b in zip(positions + velocities, precise_positions + precise_velocities))
+    return error, num_steps - 1, num_calls, positions + velocities
+
+def run_one(workload, integrator, time_step, locate_finish = False):
+    # Runs in the child process, see main().
+    start_time = time_module.perf_counter()
+    try:
+        if workload in RACES:
+            result, num_steps, num_driver_calls, final_state = run_race(workload, integrator, time_step, locate_finish)
+        else:
+            result, num_steps, num_driver_calls, final_state = run_self_test_workload(workload, integrator, time_step)
+        failure = None
+    except Exception as e:
+        result, num_steps, num_driver_calls, final_state = None, 0, 0, None
+        failure = str(e)
+    elapsed = time_module.perf_counter() - start_time
+
+    try:
+        import resource
+        # In kilobytes on Linux.
+        peak_memory_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        peak_memory_kb = None
+
+    return {
+        "workload": workload,
+        "integrator": integrator,
+        "time_step": time_step,
+        "seconds": elapsed,
+        "steps": num_steps,
+        "steps_per_second": num_steps / elapsed if elapsed > 0 else None,
+        "driver_calls": num_driver_calls,
+        "driver_calls_per_second": num_driver_calls / elapsed if elapsed > 0 else None,
+        "peak_memory_kb": peak_memory_kb,
+        "lap_time" if workload in RACES else "error": result,
+        "final_state": final_state,
+        "failure": failure,
+    }
+
+def run_in_child_process(workload, integrator, time_step, locate_finish = False):
+    output = subprocess.run([sys.executable, __file__, "--run", workload, integrator, repr(time_step)] + ["--locate-finish"] * locate_finish,
+                            capture_output = True, text = True, check = True).stdout
+    return json.loads(output)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmarks the solver on the races and the solver self test workloads.")
+    parser.add_argument("--output", default = "benchmark.json")
+    parser.add_argument("--workloads", default = ",".join(list(RACES) + list(SELF_TEST_WORKLOADS)))
+    parser.add_argument("--integrators", default = ",".join(INTEGRATORS))
+    parser.add_argument("--step-multipliers", default = "1,2",
+                        help = "Time steps to try, relative to the one the race or the self test uses.")
+    parser.add_argument("--reference-divisor", type = int, default = 4,
+                        help = "How many times smaller the time step for the reference lap times is.")
+    parser.add_argument("--run", nargs = 3, metavar = ("WORKLOAD", "INTEGRATOR", "TIME_STEP"), help = argparse.SUPPRESS)
+    parser.add_argument("--locate-finish", action = "store_true", help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        workload, integrator, time_step = args.run
+        print(json.dumps(run_one(workload, integrator, float(time_step), args.locate_finish)))
+        return
+
+    results = []
+    # (workload, time step): (integrator, final state) of the first RK4 variant
+    # that ran.
+    rk4_results = {}
+    for workload in args.workloads.split(","):
+        if workload in RACES:
+            base_time_step = RACES[workload]
+            reference = run_in_child_process(workload, "rk4_unrolled", base_time_step / args.reference_divisor)
+            print(f"{workload}: reference lap time {reference['lap_time']} ({reference['seconds']:.1f} seconds to simulate)")
+        elif workload in SELF_TEST_WORKLOADS:
+            base_time_step = SELF_TEST_WORKLOADS[workload][5]
+            reference = None
+            print(f"{workload}:")
+        else:
+            raise Exception(f"Unknown workload: {workload}")
+
+        for integrator in args.integrators.split(","):
+            for multiplier in args.step_multipliers.split(","):
+                result = run_in_child_process(workload, integrator, base_time_step * float(multiplier))
+                if reference:
+                    result["reference_lap_time"] = reference["lap_time"]
+                    if result["lap_time"] is not None and reference["lap_time"] is not None:
+                        result["error"] = abs(result["lap_time"] - reference["lap_time"])
+                    else:
+                        result["error"] = None
+                if integrator in RK4_VARIANTS and not result["failure"]:
+                    final_state = result["final_state"]
+                    expected_integrator, expected_final_state = rk4_results.setdefault((workload, result["time_step"]), (integrator, final_state))
+                    if final_state != expected_final_state:
+                        result = {key: result[key] for key in ("workload", "integrator", "time_step")}
+                        result["failure"] = f"Ends in a different state than {expected_integrator}: {final_state} vs {expected_final_state}"
+                results.append(result)
+
+                if result["failure"]:
+                    print(f"  {integrator:>16} dt={result['time_step']:<8g} FAILED: {result['failure']}")
+                else:
+                    error = "DNF" if result["error"] is None else f"{result['error']:.3g}"
+                    print(f"  {integrator:>16} dt={result['time_step']:<8g} {result['steps_per_second']:>9.0f} steps/s "
+                          f"{result['driver_calls_per_second']:>9.0f} driver calls/s {result['peak_memory_kb']} KB, error {error}")
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "python": sys.version,
+            "platform": platform.platform(),
+            "date": time_module.strftime("%Y-%m-%d %H:%M:%S"),
+            "results": results,
+        }, f, indent = 2)
+    print(f"Results were saved to '{args.output}'.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+# Checks how much a lap time depends on the time step of the simulation,
+# which is what certifying a record is about. Runs the race at dt, dt/2, dt/4
+# and dt/8 in parallel processes, estimates the order of convergence, and
+# extrapolates the lap time to an infinitely small time step (Richardson
+# extrapolation).
+#
+# The moment of the finish is located within the step in which the car crosses
+# the finish (see make_finish_event in the races), otherwise the lap time
+# would only change by whole steps and never converge smoothly.
+#
+# Usage:
+#   python certify.py race_05 [--time-step 0.0001]
+#
+# The time step defaults to the one the race uses.
+
+import argparse
+import importlib
+import math
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import benchmark
+import solver
+
+NUM_HALVINGS = 3
+
+def estimate_order(lap_times):
+    # lap_times are for time steps that halve each time. With
+    # lap_time(h) = lap_time(0) + C * h^order, every difference between
+    # consecutive lap times is 2^order times smaller than the previous one.
+    # Returns None if the differences don't shrink like that, e.g. when the
+    # lap times are already the same or bounce around.
+    orders = []
+    for i in range(len(lap_times) - 2):
+        previous_difference = lap_times[i] - lap_times[i + 1]
+        difference = lap_times[i + 1] - lap_times[i + 2]
+        if difference == 0 or previous_difference / difference <= 1:
+            return None
+        orders.append(math.log2(previous_difference / difference))
+    return orders[-1] if orders else None
+
+def extrapolate(lap_times, order):
+    # Richardson extrapolation of the last two lap times.
+    return lap_times[-1] + (lap_times[-1] - lap_times[-2]) / (math.pow(2, order) - 1)
+
+def certify(race_name, time_step):
+    # Returns a dict with the lap times, the estimated order and the
+    # extrapolated lap time with its error bar.
+    time_steps = [time_step / math.pow(2, i) for i in range(NUM_HALVINGS + 1)]
+    # The simulations themselves run in separate processes, see benchmark.py.
+    with ThreadPoolExecutor(len(time_steps)) as executor:
+        results = list(executor.map(lambda dt: benchmark.run_in_child_process(race_name, "rk4_unrolled", dt, locate_finish = True), time_steps))
+    for result in results:
+        if result["failure"]:
+            raise Exception(f"The race failed with time step {result['time_step']:g}: {result['failure']}")
+        if result["lap_time"] is None:
+            raise Exception(f"DNF with time step {result['time_step']:g}")
+    lap_times = [result["lap_time"] for result in results]
+
+    order = estimate_order(lap_times)
+    if order is None:
+        # Can't tell, e.g. because the driver switches abruptly (at a given t
+        # or x) in the middle of a step, which moves the lap time by up to a
+        # step either way. Assume the worst: the lap time is only known to
+        # within a step, or within how much it still changes, if that's more.
+        extrapolated_lap_time = lap_times[-1]
+        error = max([time_steps[-1]] + [abs(lap_time - lap_times[-1]) for lap_time in lap_times[1:]])
+    else:
+        extrapolated_lap_time = extrapolate(lap_times, order)
+        # The difference from the extrapolation that doesn't use the smallest
+        # time step is how much the extrapolation can be trusted.
+        error = max(abs(extrapolated_lap_time - extrapolate(lap_times[:-1], order)), abs(extrapolated_lap_time - lap_times[-1]))
+
+    rounded_lap_times = [round(lap_time, 3) for lap_time in lap_times]
+    stable = (len(set(rounded_lap_times)) == 1
+              and round(extrapolated_lap_time - error, 3) == rounded_lap_times[-1]
+              and round(extrapolated_lap_time + error, 3) == rounded_lap_times[-1])
+    return {
+        "time_steps": time_steps,
+        "lap_times": lap_times,
+        "order": order,
+        "extrapolated_lap_time": extrapolated_lap_time,
+        "error": error,
+        "stable": stable,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description = "Checks that a lap time doesn't depend on the time step of the simulation.")
+    parser.add_argument("race", help = "e.g. race_05")
+    parser.add_argument("--time-step", type = float, help = "The largest time step to try, by default the one the race uses.")
+    args = parser.parse_args()
+    if args.race not in benchmark.RACES:
+        raise Exception(f"Unknown race: {args.race}")
+
+    time_step = args.time_step or benchmark.RACES[args.race]
+    certificate = certify(args.race, time_step)
+    for dt, lap_time in zip(certificate["time_steps"], certificate["lap_times"]):
+        print(f"Time step {dt:g}: {lap_time:.6f} seconds.")
+    if certificate["order"] is None:
+        print("Unable to estimate the order of convergence: the lap times don't converge smoothly, "
+              "e.g. because the driver switches abruptly in the middle of a step.")
+    else:
+        print(f"Estimated order of convergence: {certificate['order']:.2f}.")
+    print(f"Extrapolated lap time: {certificate['extrapolated_lap_time']:.6f} ± {certificate['error']:.6f} seconds.")
+
+    race = importlib.import_module(args.race)
+    rounded_lap_time = round(certificate["lap_times"][-1], 3)
+    if certificate["stable"]:
+        print(f"The lap time of {rounded_lap_time:.3f} seconds is stable (the current record is {race.RECORD:.3f} seconds).")
+    else:
+        print(f"The lap time rounded to 3 decimals is NOT stable, try a smaller --time-step.")
+
+#### Self tests
+
+class TestCertify(unittest.TestCase):
+
+    def test_extrapolation(self):
+        # lap_time(h) = 10 + 3 * h^4 for h = 1, 1/2, 1/4, 1/8.
+        lap_times = [10 + 3 * math.pow(0.5, 4 * i) for i in range(4)]
+        self.assertAlmostEqual(estimate_order(lap_times), 4, places = 9)
+        self.assertAlmostEqual(extrapolate(lap_times, 4), 10, places = 12)
+
+        # Second order, converging from below.
+        lap_times = [10 - 0.1 * math.pow(0.5, 2 * i) for i in range(4)]
+        self.assertAlmostEqual(estimate_order(lap_times), 2, places = 9)
+        self.assertAlmostEqual(extrapolate(lap_times, 2), 10, places = 12)
+
+    def test_no_order(self):
+        self.assertIsNone(estimate_order([8.2186, 8.21855, 8.21855, 8.21855]))
+        self.assertIsNone(estimate_order([36.558431, 36.558528, 36.558382, 36.558455]))
+        self.assertIsNone(estimate_order([1, 2]))
+
+    def test_event_finish_converges(self):
+        # The finish located within the step with an event converges like the
+        # solver itself, unlike the first step past the finish: the pendulum
+        # x = cos(t) gets to x = 0.5 at t = pi / 3. (solveRK4 is third order,
+        # as calculateNextStateRK4 builds the last stage from k2.)
+        lap_times = []
+        for i in range(4):
+            finish = solver.Event(lambda p, v, t: p[0] - 0.5, direction = -1)
+            positions, velocities, time = solver.solveRK4([1], [0], lambda p, v, t: [-p[0]], 10, 0.1 / math.pow(2, i), None, [finish])
+            lap_times.append(time)
+        order = estimate_order(lap_times)
+        self.assertAlmostEqual(order, 3, delta = 0.1)
+        self.assertLess(abs(extrapolate(lap_times, order) - math.pi / 3), abs(lap_times[-1] - math.pi / 3))
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,12 @@
 # This file defines various things shared between all/most races.
 
+import sys
+
 def compare_lap_time_with_record_and_reference(lap_time, record, reference_time):
     time_round = round(lap_time, 3)
     if time_round < record:
         print("NEW RECORD! Congrats!! Please reach out to timurrrr@ to certify.")
+        print("Tip: run certify.py to check that the lap time doesn't depend on the time step.")
     elif time_round == record:
         print("Congrats, you've matched the record!")
     else:
@@ -13,3 +16,83 @@ def compare_lap_time_with_record_and_reference(lap_time, record, reference_time)
             print(f"This was slower than the reference solution ({reference_time:.3f} seconds).")
         print(f"The current record is {record:.3f} seconds.")
 
+
+# When a race is run with --profile (e.g. `python race_05.py --profile`),
+# returns a solver.SolverProfile to pass to the solver and print at the end.
+# The functions named in function_names (e.g. the driver) are timed as well.
+# Returns None otherwise.
+def create_solver_profile_if_requested(race_globals, function_names):
+    if "--profile" not in sys.argv:
+        return None
+    import solver
+    profile = solver.SolverProfile()
+    for name in function_names:
+        race_globals[name] = profile.wrap(name, race_globals[name])
+    return profile
+
+# When a race is run with --control-period SECONDS (e.g.
+# `python race_05.py --control-period 0.001`), returns that period: the driver
+# is then only asked every SECONDS, and its input is held in between. Returns
+# None otherwise.
+def get_control_period_if_requested():
+    if "--control-period" not in sys.argv:
+        return None
+    index = sys.argv.index("--control-period") + 1
+    if index >= len(sys.argv):
+        raise Exception("--control-period needs the period in seconds")
+    return float(sys.argv[index])
+
+# When a race is run with --save-telemetry FILE (e.g.
+# `python race_05.py --save-telemetry runs.telemetry`), appends the telemetry
+# of the run to that archive, see telemetry.TelemetryArchive. lap_time is None
+# for a DNF.
+def save_telemetry_if_requested(race, session, lap_time, time_step):
+    if "--save-telemetry" not in sys.argv:
+        return
+    index = sys.argv.index("--save-telemetry") + 1
+    if index >= len(sys.argv):
+        raise Exception("--save-telemetry needs the name of the archive file")
+    import telemetry
+    telemetry.append_to_archive(sys.argv[index], session.telemetry, race, telemetry.calculate_driver_hash(session.driver_algorithm),
+                                time_step, lap_time)
+    print(f"Telemetry was appended to '{sys.argv[index]}'.")
+
+# The result of a headless run of a race, see evaluate() in the races.
+class RaceResult:
+    def __init__(self, time, positions, velocities, failure = None):
+        # time, positions, velocities: the last state of the car, i.e. at the
+        #   finish if it finished, or where it broke the rules.
+        # failure: None if the car finished according to the rules, otherwise
+        #   why not, e.g. "DNF" or "Cut the course at ...".
+        self.time = time
+        self.positions = positions
+        self.velocities = velocities
+        self.failure = failure
+        self.finished = failure is None
+
+    def __repr__(self):
+        if self.finished:
+            return f"RaceResult(finished in {self.time:.3f} seconds)"
+        return f"RaceResult({self.failure})"
+
+# Runs solve_function(progress_listener_callback_p_v_t) with a listener that
+# only checks the rules, i.e. check_rules_p_v_t(positions, velocities, t)
+# raises an exception if they are broken and returns True at the finish.
+# Returns a RaceResult. Exceptions from before the first state of the car
+# (e.g. a bad initial state) aren't about the rules, so they're raised.
+def evaluate_race(solve_function, check_rules_p_v_t, time_limit):
+    last_state = None
+    def progress_listener_callback_p_v_t(positions, velocities, t):
+        nonlocal last_state
+        last_state = (t, positions, velocities)
+        return check_rules_p_v_t(positions, velocities, t)
+
+    try:
+        positions, velocities, time = solve_function(progress_listener_callback_p_v_t)
+    except Exception as e:
+        if last_state is None:
+            raise
+        return RaceResult(*last_state, failure = str(e))
+    if time >= time_limit:
+        return RaceResult(time, positions, velocities, failure = "DNF")
+    return RaceResult(time, positions, velocities)
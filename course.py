@@ -0,0 +1,722 @@
+# Course descriptions for the 2D races: instead of hand-writing the checks for
+# every course, a race describes its walls, corridors, cones, finish gate and
+# maybe a track of any shape, and gets check_rules_p_v_t from
+# make_check_rules_p_v_t.
+#
+# Coordinates are in meters, in the frame of reference of the track (x is right
+# on the map, y is up). Use math.inf for the sides that don't end.
+#
+# For example, race_05 is:
+#   Course(corridors = [Corridor(0, 0, 20, 120), Corridor(0, 100, math.inf, 120)],
+#          finish = Gate(120, 100, math.inf, 120))
+
+import math
+import os
+import random
+import tempfile
+import unittest
+
+DEFAULT_MESSAGE = "Cut the course at (x={x:.3f}, y={y:.3f}), t={t:.3f}"
+
+# The area x_min < x < x_max, y_min < y < y_max that the car must never be in.
+# message is formatted with x, y and t for the exception.
+class Wall:
+    def __init__(self, x_min, y_min, x_max, y_max, message = DEFAULT_MESSAGE):
+        self.x_min, self.y_min, self.x_max, self.y_max = x_min, y_min, x_max, y_max
+        self.message = message
+
+# The area x_min <= x <= x_max, y_min <= y <= y_max that the car may be in.
+# With several corridors, the car must be in at least one of them; with none,
+# it can go anywhere that isn't a wall.
+class Corridor:
+    def __init__(self, x_min, y_min, x_max, y_max, message = DEFAULT_MESSAGE):
+        self.x_min, self.y_min, self.x_max, self.y_max = x_min, y_min, x_max, y_max
+        self.message = message
+
+# A cone at (x, y) that the car must pass on the given side ("above" means
+# y >= the y of the cone when the car gets to the x of the cone, "below" means
+# y <= it). The car drives past the cones in the order they're listed, towards
+# larger x.
+class Cone:
+    def __init__(self, x, y, side, message = DEFAULT_MESSAGE):
+        if side not in ("above", "below"):
+            raise Exception(f"Unknown cone side: {side}")
+        self.x, self.y, self.side = x, y, side
+        self.message = message
+
+# The area x_min <= x <= x_max, y_min <= y <= y_max where the race finishes.
+class Gate:
+    def __init__(self, x_min, y_min, x_max, y_max):
+        self.x_min, self.y_min, self.x_max, self.y_max = x_min, y_min, x_max, y_max
+
+# Track limits of any shape, as the signed distance to the limit sampled on a
+# grid: positive on the track, negative off it. Build one with
+# distance_field_from_polygons or distance_field_from_image.
+# values[j * width + i] is the distance at (x0 + i * cell_size,
+# y0 + j * cell_size); in between, distance(x, y) interpolates bilinearly, so
+# a lookup takes the same time however complex the track is.
+class DistanceField:
+    def __init__(self, x0, y0, cell_size, width, height, values, message = DEFAULT_MESSAGE):
+        if width < 2 or height < 2 or len(values) != width * height:
+            raise Exception(f"Expected at least 2x2 values, got {len(values)} for {width}x{height}")
+        self.x0, self.y0, self.cell_size = x0, y0, cell_size
+        self.width, self.height = width, height
+        self.values = values
+        self.message = message
+
+    def distance(self, x, y):
+        fx = (x - self.x0) / self.cell_size
+        fy = (y - self.y0) / self.cell_size
+        max_i, max_j = self.width - 2, self.height - 2
+        i, j = math.floor(fx), math.floor(fy)
+        # Off the grid, continue from the closest edge of the grid.
+        outside = 0
+        if i < 0 or i > max_i or j < 0 or j > max_j:
+            clamped_fx = min(max(fx, 0), max_i + 1)
+            clamped_fy = min(max(fy, 0), max_j + 1)
+            outside = math.hypot(fx - clamped_fx, fy - clamped_fy) * self.cell_size
+            fx, fy = clamped_fx, clamped_fy
+            i, j = min(max(i, 0), max_i), min(max(j, 0), max_j)
+        tx, ty = fx - i, fy - j
+        values, k = self.values, j * self.width + i
+        bottom = values[k] + (values[k + 1] - values[k]) * tx
+        k += self.width
+        top = values[k] + (values[k + 1] - values[k]) * tx
+        return bottom + (top - bottom) * ty - outside
+
+    # Whether the whole line from (px, py) to (x, y) is on the track. Usually
+    # the line is short enough to be within the distance to the limit from
+    # either end; if not, it's checked by stepping along it by the distance to
+    # the limit (but at least 1% of a cell).
+    def is_segment_on_track(self, px, py, x, y):
+        start_distance = self.distance(px, py)
+        end_distance = self.distance(x, y)
+        if start_distance < 0 or end_distance < 0:
+            return False
+        length = math.hypot(x - px, y - py)
+        s = start_distance
+        while s < length - end_distance:
+            distance = self.distance(px + (x - px) * s / length, py + (y - py) * s / length)
+            if distance < 0:
+                return False
+            s += max(distance, self.cell_size / 100)
+        return True
+
+# The track is the area inside the polygons (lists of (x, y) points) by the
+# even-odd rule, so a polygon inside another one is a hole in the track. The
+# grid covers the polygons and margin meters around them.
+def distance_field_from_polygons(polygons, cell_size, margin = None, message = DEFAULT_MESSAGE):
+    if margin is None:
+        margin = 2 * cell_size
+    edges = []
+    for polygon in polygons:
+        for k in range(len(polygon)):
+            edges.append((polygon[k - 1], polygon[k]))
+    x0 = min(x for polygon in polygons for x, y in polygon) - margin
+    y0 = min(y for polygon in polygons for x, y in polygon) - margin
+    width = math.ceil((max(x for polygon in polygons for x, y in polygon) + margin - x0) / cell_size) + 1
+    height = math.ceil((max(y for polygon in polygons for x, y in polygon) + margin - y0) / cell_size) + 1
+
+    values = []
+    for j in range(height):
+        y = y0 + j * cell_size
+        for i in range(width):
+            x = x0 + i * cell_size
+            inside = False
+            min_distance = math.inf
+            for (ax, ay), (bx, by) in edges:
+                if (ay > y) != (by > y) and x < ax + (y - ay) * (bx - ax) / (by - ay):
+                    inside = not inside
+                dx, dy = bx - ax, by - ay
+                length_squared = dx * dx + dy * dy
+                s = 0 if length_squared == 0 else min(max(((x - ax) * dx + (y - ay) * dy) / length_squared, 0), 1)
+                min_distance = min(min_distance, math.hypot(x - ax - s * dx, y - ay - s * dy))
+            values.append(min_distance if inside else -min_distance)
+    return DistanceField(x0, y0, cell_size, width, height, values, message)
+
+# The track is the light pixels of the image (e.g. the track painted white and
+# everything else black), each pixel being cell_size meters wide. (x0, y0) is
+# the bottom left corner of the image on the map. Needs Pillow.
+def distance_field_from_image(filename, cell_size, x0 = 0, y0 = 0, threshold = 128, message = DEFAULT_MESSAGE):
+    from PIL import Image
+    image = Image.open(filename).convert("L")
+    width, height = image.size
+    pixels = image.tobytes()
+    # Bottom row first, like the map.
+    on_track = [pixels[(height - 1 - j) * width + i] >= threshold for j in range(height) for i in range(width)]
+    to_off_track = calculate_distances_to_features([not value for value in on_track], width, height)
+    to_on_track = calculate_distances_to_features(on_track, width, height)
+    # The limit is half a pixel away from the center of the last pixel on
+    # either side of it.
+    values = [(to_off_track[k] - 0.5) * cell_size if on_track[k] else -(to_on_track[k] - 0.5) * cell_size
+              for k in range(width * height)]
+    # The values are at the centers of the pixels.
+    return DistanceField(x0 + cell_size / 2, y0 + cell_size / 2, cell_size, width, height, values, message)
+
+def calculate_distances_to_features(features, width, height):
+    # The Euclidean distance transform: for every cell of the grid, the
+    # distance in cells to the closest cell where features is True, computed
+    # one dimension at a time (Felzenszwalb & Huttenlocher). inf if there are
+    # none.
+    squared = [0 if feature else math.inf for feature in features]
+    for j in range(height):
+        squared[j * width:(j + 1) * width] = calculate_squared_distances_1d(squared[j * width:(j + 1) * width])
+    for i in range(width):
+        squared[i::width] = calculate_squared_distances_1d(squared[i::width])
+    return [math.sqrt(value) for value in squared]
+
+def calculate_squared_distances_1d(f):
+    # The lower envelope of the parabolas (q - p)^2 + f[p].
+    n = len(f)
+    sources = [p for p in range(n) if f[p] < math.inf]
+    if not sources:
+        return f
+    vertices = [sources[0]]
+    boundaries = [-math.inf]
+    for q in sources[1:]:
+        while True:
+            p = vertices[-1]
+            s = ((f[q] + q * q) - (f[p] + p * p)) / (2 * q - 2 * p)
+            if s <= boundaries[-1]:
+                vertices.pop()
+                boundaries.pop()
+            else:
+                break
+        vertices.append(q)
+        boundaries.append(s)
+    boundaries.append(math.inf)
+    result = []
+    k = 0
+    for q in range(n):
+        while boundaries[k + 1] < q:
+            k += 1
+        p = vertices[k]
+        result.append((q - p) * (q - p) + f[p])
+    return result
+
+class Course:
+    # track is a DistanceField, for the limits that aren't axis-aligned walls
+    # or corridors.
+    def __init__(self, walls = (), corridors = (), cones = (), finish = None, track = None):
+        self.walls = list(walls)
+        self.corridors = list(corridors)
+        self.cones = list(cones)
+        self.finish = finish
+        self.track = track
+        self.make_check_rules_function = None
+
+    # How far the car is from getting into the finish gate: positive outside
+    # of it, zero or negative in it. Unlike check_rules_p_v_t it changes
+    # smoothly, so it can be the function of a solver.Event that finds the
+    # moment of the finish between two steps.
+    def calculate_distance_outside_finish_p(self, positions):
+        finish = self.finish
+        x, y = positions[0], positions[1]
+        return max(finish.x_min - x, x - finish.x_max, finish.y_min - y, y - finish.y_max)
+
+    # Returns check_rules_p_v_t(positions, velocities, t), which raises an
+    # exception if the rules of the course are broken and returns True at the
+    # finish. Every run of the race needs a new one, as it remembers the
+    # previous position of the car and the cones it has passed.
+    # on_cone_passed(cone_number, x, y, t) is called for each one, cone_number
+    # starting at 1.
+    def make_check_rules_p_v_t(self, on_cone_passed = None):
+        if self.make_check_rules_function is None:
+            source = generate_check_rules_source(self)
+            namespace = {"course": self, "math": math, "calculate_segment_interval": calculate_segment_interval,
+                         "check_segment": check_segment, "check_corridors_segment": check_corridors_segment}
+            exec(compile(source, "<course rules>", "exec"), namespace)
+            self.make_check_rules_function = namespace["make_check_rules_p_v_t"]
+        return self.make_check_rules_function(on_cone_passed)
+
+# The checks are compiled into Python code with the numbers inlined. The walls
+# and the corridors are split into bands along x, and the code picks the band
+# of the car with a binary search, so that each step only checks what's next
+# to the car. Only the next cone is checked, too.
+#
+# Every check covers the straight line from the previous position of the car
+# to the current one, not only the current position, so that the car can't
+# jump over a corner, a cone or the finish in one step, however big the time
+# step is. Within a band, the walls and the corridors span the whole band along
+# x, so that only takes comparing the y of both ends; lines that cross into
+# another band go through check_segment.
+def generate_check_rules_source(course):
+    edges = sorted(set(value for area in course.walls + course.corridors for value in (area.x_min, area.x_max) if not math.isinf(value)))
+    band_bounds = [-math.inf] + edges + [math.inf]
+
+    lines = ["def make_check_rules_p_v_t(on_cone_passed):"]
+    lines.append("    walls, corridors, cones = course.walls, course.corridors, course.cones")
+    if course.track:
+        lines.append("    is_segment_on_track = course.track.is_segment_on_track")
+    lines.append("    next_cone = 0")
+    lines.append("    next_cone_x = cones[0].x if cones else math.inf")
+    lines.append("    prev_x, prev_y = None, None")
+    lines.append("    def check_rules_p_v_t(positions, velocities, t):")
+    lines.append("        nonlocal next_cone, next_cone_x, prev_x, prev_y")
+    lines.append("        x, y = positions[0], positions[1]")
+    lines.append("        if prev_x is None:")
+    lines.append("            prev_x, prev_y = x, y")
+    lines.append("        px, py = prev_x, prev_y")
+    lines += generate_band_checks(course, band_bounds, 0, len(band_bounds) - 1, "        ")
+    if course.track:
+        lines.append("        if not is_segment_on_track(px, py, x, y):")
+        lines.append("            raise Exception(course.track.message.format(x = x, y = y, t = t))")
+
+    if course.cones:
+        # Only the next cone is checked, and only once the car gets to it.
+        lines.append("        while x >= next_cone_x:")
+        lines.append("            cone = cones[next_cone]")
+        lines.append("            # Where the car got to the x of the cone.")
+        lines.append("            cone_y = y if px >= cone.x else py + (cone.x - px) * (y - py) / (x - px)")
+        lines.append("            if (cone_y < cone.y) if cone.side == \"above\" else (cone_y > cone.y):")
+        lines.append("                raise Exception(cone.message.format(x = cone.x, y = cone_y, t = t))")
+        lines.append("            next_cone += 1")
+        lines.append("            next_cone_x = cones[next_cone].x if next_cone < len(cones) else math.inf")
+        lines.append("            if on_cone_passed:")
+        lines.append("                on_cone_passed(next_cone, x, y, t)")
+
+    lines.append("        prev_x, prev_y = x, y")
+    if course.finish:
+        finish = course.finish
+        # Only look for the line crossing the gate if it's anywhere near it.
+        near = [f"(px >= {finish.x_min!r} or x >= {finish.x_min!r})", f"(px <= {finish.x_max!r} or x <= {finish.x_max!r})",
+                f"(py >= {finish.y_min!r} or y >= {finish.y_min!r})", f"(py <= {finish.y_max!r} or y <= {finish.y_max!r})"]
+        near = [condition for condition, bound in zip(near, (finish.x_min, finish.x_max, finish.y_min, finish.y_max)) if not math.isinf(bound)]
+        lines.append("        return (" + (generate_area_condition(finish, "<=", -math.inf, math.inf) or "True") + ") or ("
+                     + " and ".join(near + ["calculate_segment_interval(course.finish, px, py, x, y) is not None"]) + ")")
+    else:
+        lines.append("        return False")
+    lines.append("    return check_rules_p_v_t")
+    return "\n".join(lines) + "\n"
+
+def generate_band_checks(course, band_bounds, first, last, indent):
+    # Returns the lines that check the bands from band_bounds[first] to
+    # band_bounds[last]. Every band gets its own branch, even an empty one, see
+    # below.
+    if last - first > 1:
+        middle = (first + last) // 2
+        below = generate_band_checks(course, band_bounds, first, middle, indent + "    ")
+        above = generate_band_checks(course, band_bounds, middle, last, indent + "    ")
+        return [f"{indent}if x < {band_bounds[middle]!r}:"] + below + [f"{indent}else:"] + above
+
+    lines = []
+    band_min, band_max = band_bounds[first], band_bounds[last]
+    for i, wall in enumerate(course.walls):
+        if wall.x_min < band_max and wall.x_max > band_min:
+            # Some point between the ends is in the wall along y.
+            condition = generate_area_condition(wall, "<", -math.inf, math.inf, "py", "y", " or ", False)
+            if (not math.isinf(wall.x_min) and wall.x_min >= band_min) or (not math.isinf(wall.x_max) and wall.x_max < band_max):
+                # The wall doesn't cover the whole band along x.
+                condition = " and ".join(([condition] if condition else []) + [f"calculate_segment_interval(walls[{i}], px, py, x, y, True) is not None"])
+            lines += generate_raise(condition, f"walls[{i}].message", indent)
+
+    if course.corridors:
+        conditions = []
+        for corridor in course.corridors:
+            if corridor.x_min < band_max and corridor.x_max >= band_min:
+                condition = generate_area_condition(corridor, "<=", band_min, band_max)
+                # Both ends in the same corridor means the whole line is in it.
+                conditions.append(condition and generate_area_condition(corridor, "<=", band_min, band_max, "px", "py") + " and " + condition)
+        # Nothing to check if a corridor covers the whole band.
+        if None not in conditions:
+            if len(conditions) > 1:
+                conditions = [f"({condition})" for condition in conditions]
+            if conditions:
+                lines.append(f"{indent}if not ({' or '.join(conditions)}):")
+                lines.append(f"{indent}    check_corridors_segment(course, px, py, x, y, t)")
+            else:
+                lines.append(f"{indent}check_corridors_segment(course, px, py, x, y, t)")
+
+    # Even a band with nothing in it needs the check of the lines that come
+    # from another band, as they can go through the walls of the bands between.
+    band_condition = " and ".join([f"px >= {band_min!r}"] * (not math.isinf(band_min)) + [f"px < {band_max!r}"] * (not math.isinf(band_max)))
+    if band_condition and lines:
+        lines = [f"{indent}if {band_condition}:"] + [line.replace(indent, indent + "    ", 1) for line in lines]
+        lines += [f"{indent}else:", f"{indent}    check_segment(course, px, py, x, y, t)"]
+    elif band_condition and (course.walls or course.corridors):
+        lines = [f"{indent}if not ({band_condition}):", f"{indent}    check_segment(course, px, py, x, y, t)"]
+    return lines
+
+def generate_raise(condition, message, indent):
+    # Raises unconditionally if condition is None.
+    raise_line = f"raise Exception({message}.format(x = x, y = y, t = t))"
+    if condition is None:
+        return [indent + raise_line]
+    return [f"{indent}if {condition}:", f"{indent}    {raise_line}"]
+
+def generate_area_condition(area, less, band_min, band_max, x = "x", y = "y", join = " and ", check_x = True):
+    # The condition for (x, y) being in the area, for x in [band_min, band_max).
+    # less is "<" for open areas and "<=" for closed ones. Returns None if it's
+    # always true, e.g. the area covers the whole band. With join = " or ", x
+    # and y are the two ends of a line instead, and the condition is for some
+    # point of the line being within the limits of the area along y.
+    def along_y(condition):
+        if join == " and ":
+            return condition.format(y = y)
+        return "(" + condition.format(y = x) + " or " + condition.format(y = y) + ")"
+    conditions = []
+    if check_x:
+        if not math.isinf(area.x_min) and (area.x_min > band_min or (less == "<" and area.x_min == band_min)):
+            conditions.append(f"{area.x_min!r} {less} {x}")
+        if not math.isinf(area.x_max) and area.x_max < band_max:
+            conditions.append(f"{x} {less} {area.x_max!r}")
+    if not math.isinf(area.y_min):
+        conditions.append(along_y(f"{area.y_min!r} {less} {{y}}"))
+    if not math.isinf(area.y_max):
+        conditions.append(along_y(f"{{y}} {less} {area.y_max!r}"))
+    return " and ".join(conditions) or None
+
+# The range (s_min, s_max) of s in [0, 1] for which the point
+# (px + s * (x - px), py + s * (y - py)) is in the area (Liang-Barsky), or
+# None if there's none. With strict, the area doesn't include its edges.
+def calculate_segment_interval(area, px, py, x, y, strict = False):
+    s_min, s_max = 0, 1
+    for p, d, low, high in ((px, x - px, area.x_min, area.x_max), (py, y - py, area.y_min, area.y_max)):
+        if d == 0:
+            if (p <= low or p >= high) if strict else (p < low or p > high):
+                return None
+            continue
+        s_low, s_high = (low - p) / d, (high - p) / d
+        if d < 0:
+            s_low, s_high = s_high, s_low
+        s_min, s_max = max(s_min, s_low), min(s_max, s_high)
+    if (s_min >= s_max) if strict else (s_min > s_max):
+        return None
+    return s_min, s_max
+
+# Checks the line from (px, py) to (x, y) against all the walls and the
+# corridors, for lines that cross the bands of generate_check_rules_source.
+def check_segment(course, px, py, x, y, t):
+    for wall in course.walls:
+        interval = calculate_segment_interval(wall, px, py, x, y, True)
+        if interval is not None:
+            s = interval[0]
+            raise Exception(wall.message.format(x = px + s * (x - px), y = py + s * (y - py), t = t))
+    if course.corridors:
+        check_corridors_segment(course, px, py, x, y, t)
+
+# Raises if any part of the line from (px, py) to (x, y) isn't in any of the
+# corridors.
+def check_corridors_segment(course, px, py, x, y, t):
+    intervals = sorted(interval for interval in (calculate_segment_interval(corridor, px, py, x, y) for corridor in course.corridors) if interval is not None)
+    covered = 0
+    for s_min, s_max in intervals:
+        if s_min > covered:
+            break
+        covered = max(covered, s_max)
+    else:
+        if intervals and covered >= 1:
+            return
+    s = min(covered, 1) if intervals and intervals[0][0] == 0 else 0
+    raise Exception(course.corridors[0].message.format(x = px + s * (x - px), y = py + s * (y - py), t = t))
+
+#### Self tests
+
+# The rules of the course at one point, checked the straightforward way, to
+# compare the compiled checks with.
+def check_point_reference(course, x, y):
+    for wall in course.walls:
+        if wall.x_min < x < wall.x_max and wall.y_min < y < wall.y_max:
+            return "wall"
+    if course.corridors and not any(corridor.x_min <= x <= corridor.x_max and corridor.y_min <= y <= corridor.y_max
+                                    for corridor in course.corridors):
+        return "corridor"
+    finish = course.finish
+    return finish is not None and finish.x_min <= x <= finish.x_max and finish.y_min <= y <= finish.y_max
+
+# The same from a new check_rules_p_v_t, i.e. without a previous position.
+def check_point(course, x, y):
+    try:
+        return course.make_check_rules_p_v_t()([x, y], [0, 0], 0)
+    except Exception as e:
+        return "wall" if "wall" in str(e) else "corridor"
+
+class TestCourse(unittest.TestCase):
+
+    def assertPointsMatchReference(self, course, xs, ys):
+        for x in xs:
+            for y in ys:
+                self.assertEqual(check_point(course, x, y), check_point_reference(course, x, y), f"at ({x}, {y})")
+
+    def test_walls(self):
+        # race_03.
+        course = Course(walls = [Wall(-math.inf, 20, 20, math.inf, message = "wall"),
+                                 Wall(60, 20, math.inf, math.inf, message = "wall"),
+                                 Wall(-math.inf, 60, math.inf, math.inf, message = "wall")],
+                        finish = Gate(50, -math.inf, 70, 0))
+        # On the edges, and just to either side of them.
+        values = sorted(set(v + d for v in range(-20, 100, 10) for d in (-1e-9, 0, 1e-9)))
+        self.assertPointsMatchReference(course, values, values)
+
+    def test_corridors(self):
+        # race_05, with a gap between two more corridors and one inside another.
+        course = Course(corridors = [Corridor(0, 0, 20, 120), Corridor(0, 100, math.inf, 120),
+                                     Corridor(30, -20, 40, 0), Corridor(50, -20, 60, 0), Corridor(5, 10, 15, 20)],
+                        finish = Gate(120, 100, math.inf, 120))
+        values = sorted(set(v + d for v in range(-30, 140, 10) for d in (-1e-9, 0, 1e-9)))
+        self.assertPointsMatchReference(course, values, values)
+
+    def test_many_walls_and_corridors(self):
+        # Enough edges for a few levels of the binary search over the bands.
+        generator = random.Random(42)
+        def random_area(area_type):
+            x_min, y_min = generator.randrange(-50, 50), generator.randrange(-50, 50)
+            return area_type(x_min, y_min, x_min + generator.randrange(1, 40), y_min + generator.randrange(1, 40))
+        walls = [random_area(Wall) for i in range(10)]
+        for wall in walls:
+            wall.message = "wall"
+        course = Course(walls = walls,
+                        corridors = [random_area(Corridor) for i in range(10)] + [Corridor(-math.inf, -60, math.inf, -40)],
+                        finish = Gate(-20, -60, -10, -40))
+        values = sorted(set(v + d for v in range(-60, 100, 1) for d in (-1e-9, 0)))
+        self.assertPointsMatchReference(course, values, values)
+
+    def test_finish_gate_edges(self):
+        # The gate is closed: race_03 finishes at y <= 0, not only y < 0.
+        course = Course(finish = Gate(50, -math.inf, 70, 0))
+        self.assertTrue(check_point(course, 60, 0))
+        self.assertTrue(check_point(course, 50, -10))
+        self.assertTrue(check_point(course, 70, -1e9))
+        self.assertFalse(check_point(course, 60, 1e-9))
+        self.assertFalse(check_point(course, 50 - 1e-9, -10))
+        self.assertFalse(check_point(course, 70 + 1e-9, -10))
+
+    def test_cones(self):
+        # race_04: drive along y = 20 and swerve past each cone on its side.
+        cones = [Cone(40, 40, "above"), Cone(80, 0, "below"), Cone(120, 40, "above"), Cone(160, 0, "below"), Cone(200, 40, "above")]
+        course = Course(corridors = [Corridor(-math.inf, -10, math.inf, 50)], cones = cones, finish = Gate(210, -math.inf, 230, 0))
+        def drive(path_y):
+            passed = []
+            check_rules_p_v_t = course.make_check_rules_p_v_t(lambda cone_number, x, y, t: passed.append(cone_number))
+            x = 0
+            try:
+                while not check_rules_p_v_t([x, path_y(x)], [1, 0], x):
+                    x += 0.5
+            except Exception as e:
+                return passed, str(e)
+            return passed, x
+
+        def swerve(x):
+            for cone in cones:
+                if abs(x - cone.x) <= 5:
+                    return cone.y + 5 if cone.side == "above" else cone.y - 5
+            return -5 if x > 205 else 20
+        self.assertEqual(drive(swerve), ([1, 2, 3, 4, 5], 210))
+
+        # Past the second cone on the wrong side.
+        wrong_side = lambda x: 5 if abs(x - 80) <= 5 else swerve(x)
+        self.assertEqual(drive(wrong_side), ([1], DEFAULT_MESSAGE.format(x = 80, y = 5, t = 80)))
+
+        # Cone 40 is only checked once the car gets to x = 40, and exactly at
+        # y = 40 is still above it.
+        self.assertEqual(drive(lambda x: 40 if x == 40 else swerve(x))[0], [1, 2, 3, 4, 5])
+
+    def test_segment_interval(self):
+        area = Corridor(0, 0, 10, 10)
+        self.assertEqual(calculate_segment_interval(area, -10, 5, 30, 5), (0.25, 0.5))
+        self.assertEqual(calculate_segment_interval(area, 5, 20, 5, -20), (0.25, 0.5))
+        self.assertEqual(calculate_segment_interval(area, 5, 5, 5, 5), (0, 1))
+        self.assertIsNone(calculate_segment_interval(area, -10, 11, 30, 11))
+        # Along an edge, or touching a corner: in the closed area, not in the
+        # open one.
+        self.assertEqual(calculate_segment_interval(area, -10, 10, 30, 10), (0.25, 0.5))
+        self.assertIsNone(calculate_segment_interval(area, -10, 10, 30, 10, True))
+        self.assertEqual(calculate_segment_interval(area, 0, 20, 20, 0), (0.5, 0.5))
+        self.assertIsNone(calculate_segment_interval(area, 0, 20, 20, 0, True))
+
+    def test_step_jumps_corner(self):
+        # race_03, with both ends of each step on the course.
+        course = Course(walls = [Wall(-math.inf, 20, 20, math.inf), Wall(60, 20, math.inf, math.inf),
+                                 Wall(-math.inf, 60, math.inf, math.inf)])
+        check_rules_p_v_t = course.make_check_rules_p_v_t()
+        check_rules_p_v_t([0, 10], [0, 0], 0)
+        with self.assertRaisesRegex(Exception, r"Cut the course at \(x=7\.500, y=20\.000\), t=1\.000"):
+            check_rules_p_v_t([30, 50], [0, 0], 1)
+        # Across the bands of the walls without cutting anything.
+        check_rules_p_v_t = course.make_check_rules_p_v_t()
+        check_rules_p_v_t([0, 10], [0, 0], 0)
+        check_rules_p_v_t([55, 30], [0, 0], 1)
+        check_rules_p_v_t([40, 60], [0, 0], 2)
+
+        # race_05: the L of two corridors.
+        course = Course(corridors = [Corridor(0, 0, 20, 120), Corridor(0, 100, math.inf, 120)])
+        check_rules_p_v_t = course.make_check_rules_p_v_t()
+        check_rules_p_v_t([10, 50], [0, 0], 0)
+        with self.assertRaisesRegex(Exception, r"Cut the course at \(x=20\.000, y=62\.000\)"):
+            check_rules_p_v_t([60, 110], [0, 0], 1)
+        # From one corridor into the other one where they overlap.
+        check_rules_p_v_t = course.make_check_rules_p_v_t()
+        check_rules_p_v_t([15, 100], [0, 0], 0)
+        check_rules_p_v_t([45, 115], [0, 0], 1)
+
+    def test_step_through_wall_from_empty_band(self):
+        # Both ends in bands without walls, on either side of the wall.
+        course = Course(walls = [Wall(0, 0, 10, 10)])
+        for start, end in (([15, 5], [-5, 5]), ([-5, 5], [15, 5]), ([5, 15], [15, -5])):
+            check_rules_p_v_t = course.make_check_rules_p_v_t()
+            check_rules_p_v_t(start, [0, 0], 0)
+            with self.assertRaisesRegex(Exception, "Cut the course"):
+                check_rules_p_v_t(end, [0, 0], 1)
+        check_rules_p_v_t = course.make_check_rules_p_v_t()
+        check_rules_p_v_t([15, 15], [0, 0], 0)
+        self.assertFalse(check_rules_p_v_t([-5, 11], [0, 0], 1))
+
+    def test_random_steps(self):
+        # Steps between random points, against check_segment, which checks the
+        # whole line against every wall and corridor. Many steps end in a band
+        # without walls.
+        generator = random.Random(42)
+        def random_area(area_type):
+            x_min, y_min = generator.uniform(-50, 50), generator.uniform(-50, 50)
+            return area_type(x_min, y_min, x_min + generator.uniform(1, 40), y_min + generator.uniform(1, 40))
+        def is_broken(check, *args):
+            try:
+                check(*args)
+            except Exception:
+                return True
+            return False
+
+        num_broken = 0
+        for k in range(200):
+            course = Course(walls = [random_area(Wall) for i in range(generator.randrange(1, 5))],
+                            corridors = [random_area(Corridor) for i in range(generator.randrange(3))] if k % 2 else [])
+            for i in range(50):
+                start = [generator.uniform(-60, 100), generator.uniform(-60, 100)]
+                end = [generator.uniform(-60, 100), generator.uniform(-60, 100)]
+                if is_broken(check_segment, course, *start, *start, 0):
+                    continue
+                check_rules_p_v_t = course.make_check_rules_p_v_t()
+                check_rules_p_v_t(start, [0, 0], 0)
+                expected = is_broken(check_segment, course, *start, *end, 1)
+                self.assertEqual(is_broken(check_rules_p_v_t, end, [0, 0], 1), expected, f"from {start} to {end}")
+                num_broken += expected
+        # Enough of both to mean something.
+        self.assertGreater(num_broken, 1000)
+
+    def test_step_passes_two_cones(self):
+        # race_04.
+        course = Course(corridors = [Corridor(-math.inf, -10, math.inf, 50)],
+                        cones = [Cone(40, 40, "above"), Cone(80, 0, "below"), Cone(120, 40, "above")])
+        passed = []
+        check_rules_p_v_t = course.make_check_rules_p_v_t(lambda cone_number, x, y, t: passed.append(cone_number))
+        check_rules_p_v_t([39, 45], [0, 0], 0)
+        check_rules_p_v_t([81, -5], [0, 0], 1)
+        self.assertEqual(passed, [1, 2])
+
+        # The first one on the right side, the second one on the wrong side.
+        passed = []
+        check_rules_p_v_t = course.make_check_rules_p_v_t(lambda cone_number, x, y, t: passed.append(cone_number))
+        check_rules_p_v_t([39, 45], [0, 0], 0)
+        with self.assertRaisesRegex(Exception, r"Cut the course at \(x=80\.000, y=20\.595\)"):
+            check_rules_p_v_t([81, 20], [0, 0], 1)
+        self.assertEqual(passed, [1])
+
+    def test_step_crosses_gate(self):
+        course = Course(finish = Gate(50, -10, 70, 0))
+        # Both ends outside of the gate, once across it and once past it.
+        check_rules_p_v_t = course.make_check_rules_p_v_t()
+        self.assertFalse(check_rules_p_v_t([40, 5], [0, 0], 0))
+        self.assertTrue(check_rules_p_v_t([80, -5], [0, 0], 1))
+        check_rules_p_v_t = course.make_check_rules_p_v_t()
+        self.assertFalse(check_rules_p_v_t([40, 5], [0, 0], 0))
+        self.assertFalse(check_rules_p_v_t([80, 1], [0, 0], 1))
+        # Over the whole gate along y.
+        check_rules_p_v_t = course.make_check_rules_p_v_t()
+        self.assertFalse(check_rules_p_v_t([60, 5], [0, 0], 0))
+        self.assertTrue(check_rules_p_v_t([60, -20], [0, 0], 1))
+
+    def test_checkers_are_independent(self):
+        # Every check_rules_p_v_t of a course has its own previous position and
+        # next cone, even though the compiled code is shared.
+        course = Course(cones = [Cone(40, 40, "above")], finish = Gate(50, -math.inf, 70, 0))
+        first = course.make_check_rules_p_v_t()
+        first([30, 50], [0, 0], 0)
+        first([45, 50], [0, 0], 1)
+        second = course.make_check_rules_p_v_t()
+        with self.assertRaises(Exception):
+            second([45, 30], [0, 0], 0)
+        # A reused checker would take the step below from (45, 50) and finish;
+        # a new one checks the cone again.
+        self.assertTrue(first([60, -1], [0, 0], 2))
+        third = course.make_check_rules_p_v_t()
+        third([30, 50], [0, 0], 0)
+        with self.assertRaises(Exception):
+            third([60, -1], [0, 0], 1)
+
+    def test_distance_field_lookup(self):
+        # 3x2 values at the corners of two 2 meter cells starting at (10, 20).
+        field = DistanceField(10, 20, 2, 3, 2, [0, 1, 2,
+                                                3, 4, 5])
+        self.assertEqual(field.distance(10, 20), 0)
+        self.assertEqual(field.distance(14, 22), 5)
+        self.assertEqual(field.distance(11, 20), 0.5)
+        self.assertEqual(field.distance(13, 21), 3)
+        # Off the grid, the value at the closest edge minus the distance to it.
+        self.assertEqual(field.distance(7, 20), -3)
+        self.assertEqual(field.distance(14, 26), 1)
+        self.assertEqual(field.distance(17, 26), 0)
+        with self.assertRaises(Exception):
+            DistanceField(0, 0, 1, 3, 2, [0, 1, 2])
+
+    def test_distance_field_from_polygons(self):
+        # A 20x20 square with a 10x10 hole in the middle.
+        field = distance_field_from_polygons([[(0, 0), (20, 0), (20, 20), (0, 20)], [(5, 5), (15, 5), (15, 15), (5, 15)]], 0.5)
+        # Positive on the track, negative off it and in the hole.
+        self.assertAlmostEqual(field.distance(2, 10), 2)
+        self.assertAlmostEqual(field.distance(10, 18), 2)
+        self.assertAlmostEqual(field.distance(-1, 10), -1)
+        self.assertAlmostEqual(field.distance(10, 10), -5)
+        self.assertAlmostEqual(field.distance(10, 6), -1)
+        self.assertTrue(field.is_segment_on_track(2, 2, 18, 2))
+        self.assertTrue(field.is_segment_on_track(2, 2, 2, 18))
+        self.assertFalse(field.is_segment_on_track(2, 2, 18, 18))
+        self.assertFalse(field.is_segment_on_track(2, 2, 22, 2))
+
+        course = Course(track = field)
+        check_rules_p_v_t = course.make_check_rules_p_v_t()
+        check_rules_p_v_t([2, 2], [0, 0], 0)
+        check_rules_p_v_t([18, 2], [0, 0], 1)
+        with self.assertRaisesRegex(Exception, "Cut the course"):
+            check_rules_p_v_t([2, 18], [0, 0], 2)
+
+    def test_distances_to_features(self):
+        # Against the distance to every feature.
+        generator = random.Random(42)
+        width, height = 13, 7
+        features = [generator.random() < 0.1 for k in range(width * height)]
+        expected = [min([math.hypot(i - fi, j - fj) for fj in range(height) for fi in range(width) if features[fj * width + fi]],
+                        default = math.inf)
+                    for j in range(height) for i in range(width)]
+        distances = calculate_distances_to_features(features, width, height)
+        for actual, expected_distance in zip(distances, expected):
+            self.assertAlmostEqual(actual, expected_distance)
+        self.assertEqual(calculate_distances_to_features([False] * 6, 3, 2), [math.inf] * 6)
+
+    def test_distance_field_from_image(self):
+        try:
+            from PIL import Image
+        except ImportError:
+            self.skipTest("Needs Pillow")
+        # A white 6x4 pixel track in a black 10x10 image, 2 meters per pixel,
+        # i.e. x from 4 to 16 and y from 8 to 16 on the map. The values are at
+        # the centers of the pixels.
+        image = Image.new("L", (10, 10), 0)
+        for i in range(2, 8):
+            for j in range(2, 6):
+                image.putpixel((i, j), 255)
+        fd, filename = tempfile.mkstemp(suffix = ".png")
+        os.close(fd)
+        try:
+            image.save(filename)
+            field = distance_field_from_image(filename, 2)
+        finally:
+            os.remove(filename)
+        self.assertAlmostEqual(field.distance(5, 9), 1)
+        self.assertAlmostEqual(field.distance(9, 11), 3)
+        self.assertAlmostEqual(field.distance(15, 11), 1)
+        self.assertAlmostEqual(field.distance(1, 11), -3)
+        self.assertAlmostEqual(field.distance(9, 19), -3)
+        self.assertAlmostEqual(field.distance(9, 16), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
 import math
+import unittest
 from PIL import Image, ImageColor, ImageDraw
 
 white = ImageColor.getrgb("#ffffff")
@@ -27,17 +28,17 @@ def plot_graphs(data_log, output_filename):
         min_horizontal = 0
         max_vertical = 1
         min_vertical = 0
-        for point in data_series:
-            if point[0]:
-                # Round the values for grid min/max purposes so that minor
-                # rounding/integration errors don't create unnecessary grid lines.
-                rounded_point = round(point[0], 1)
-                max_vertical = max(rounded_point, max_vertical)
-                min_vertical = min(rounded_point, min_vertical)
-            if point[1]:
-                rounded_point = round(point[1], 1)
-                max_horizontal = max(rounded_point, max_horizontal)
-                min_horizontal = min(rounded_point, min_horizontal)
+        bounds = calculate_bounds(data_series)
+        if bounds[0] is not None:
+            # Round the values for grid min/max purposes so that minor
+            # rounding/integration errors don't create unnecessary grid lines.
+            # Rounding the min/max is the same as taking the min/max of the
+            # rounded values.
+            min_vertical = min(round(bounds[0], 1), min_vertical)
+            max_vertical = max(round(bounds[1], 1), max_vertical)
+        if bounds[2] is not None:
+            min_horizontal = min(round(bounds[2], 1), min_horizontal)
+            max_horizontal = max(round(bounds[3], 1), max_horizontal)
 
         # Horizontal grid (vertical grid lines)
         grid_step_horizontal = 1
@@ -79,15 +80,9 @@ def plot_graphs(data_log, output_filename):
         draw.line([start_x, start_y - height, start_x + 4, start_y - height + 8], black, 2)
         draw.line([start_x, start_y - height, start_x - 4, start_y - height + 8], black, 2)
 
-        prev_xy = None
-        for data_point in data_series:
-            if data_point[0] and data_point[1]:
-                this_xy = [start_x + data_point[1] * scale_horizontal, start_y - (data_point[0] - min_vertical) * scale_vertical]
-            else:
-                this_xy = None
-            if prev_xy and this_xy:
-                draw.line([prev_xy[0], prev_xy[1], this_xy[0], this_xy[1]], data_line_color, 2)
-            prev_xy = this_xy
+        for polyline in downsample_to_pixel_columns(data_series, start_x, scale_horizontal, start_y, min_vertical, scale_vertical):
+            if len(polyline) > 1:
+                draw.line(polyline, data_line_color, 2)
 
         # Axis labels
         draw.text([start_x + width, horizontal_axis_y - 8], horizontal_axis_label, fill=black, anchor="rs")
@@ -99,4 +94,93 @@ def plot_graphs(data_log, output_filename):
 
         draw.text([start_x + 12, start_y - height], vertical_axis_label, fill=black, anchor="ls")
 
-    img.save(output_filename, "PNG")
\ No newline at end of file
+    img.save(output_filename, "PNG")
+
+# Returns (min vertical, max vertical, min horizontal, max horizontal) of the
+# data points, skipping the missing and zero values like the graphs do. None
+# if there are no such values.
+def calculate_bounds(data_series):
+    min_vertical = max_vertical = min_horizontal = max_horizontal = None
+    for vertical, horizontal in data_series:
+        if vertical:
+            if min_vertical is None:
+                min_vertical = max_vertical = vertical
+            elif vertical < min_vertical:
+                min_vertical = vertical
+            elif vertical > max_vertical:
+                max_vertical = vertical
+        if horizontal:
+            if min_horizontal is None:
+                min_horizontal = max_horizontal = horizontal
+            elif horizontal < min_horizontal:
+                min_horizontal = horizontal
+            elif horizontal > max_horizontal:
+                max_horizontal = horizontal
+    return min_vertical, max_vertical, min_horizontal, max_horizontal
+
+# Converts the data points to the polylines to draw, in pixels. A polyline
+# ends at a missing data point. There can be thousands of data points per
+# pixel column, so for every run of consecutive data points in the same column
+# only the first, the lowest, the highest and the last ones are kept: the lines
+# between them cover the same pixels.
+def downsample_to_pixel_columns(data_series, start_x, scale_horizontal, start_y, min_vertical, scale_vertical):
+    polylines = []
+    polyline = []
+    # The current run of data points in one column: (index, x, y) of the
+    # first, the lowest, the highest and the last ones.
+    column = None
+    run = None
+    def end_run():
+        if run:
+            points = sorted(set(run))
+            polyline.extend((x, y) for _, x, y in points)
+
+    for index, (vertical, horizontal) in enumerate(data_series):
+        if not (vertical and horizontal):
+            end_run()
+            run = None
+            column = None
+            if polyline:
+                polylines.append(polyline)
+                polyline = []
+            continue
+        point = (index, start_x + horizontal * scale_horizontal, start_y - (vertical - min_vertical) * scale_vertical)
+        point_column = math.floor(point[1])
+        if point_column != column:
+            end_run()
+            column = point_column
+            run = [point, point, point, point]
+        else:
+            # Higher on the graph is smaller y.
+            if point[2] > run[1][2]:
+                run[1] = point
+            if point[2] < run[2][2]:
+                run[2] = point
+            run[3] = point
+    end_run()
+    if polyline:
+        polylines.append(polyline)
+    return polylines
+
+#### Self tests
+
+class TestDataLogPlotter(unittest.TestCase):
+
+    def test_downsample_to_pixel_columns(self):
+        # With these scales a data point (vertical, horizontal) is at
+        # (horizontal, -vertical) in pixels.
+        data_series = [(3, 1.0), (1, 1.2), (5, 1.4), (2, 1.6), (4, 1.8), (2, 2.5), (None, 3.0), (1, 3.5), (2, 3.6), (3, 3.7), (None, 4)]
+        polylines = downsample_to_pixel_columns(data_series, 0, 1, 0, 0, 1)
+        # In column 1 the first, the lowest, the highest and the last ones, in
+        # their order; the only one in column 2; then a new polyline after the
+        # missing data point.
+        self.assertEqual(polylines, [[(1.0, -3), (1.2, -1), (1.4, -5), (1.8, -4), (2.5, -2)],
+                                     [(3.5, -1), (3.7, -3)]])
+        self.assertEqual(downsample_to_pixel_columns([(None, 1), (None, 2)], 0, 1, 0, 0, 1), [])
+
+    def test_calculate_bounds(self):
+        self.assertEqual(calculate_bounds([(3, 1), (None, 2), (-1, 5), (7, 4)]), (-1, 7, 1, 5))
+        self.assertEqual(calculate_bounds([(None, None)]), (None, None, None, None))
+
+if __name__ == '__main__':
+    unittest.main()
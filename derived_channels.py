@@ -0,0 +1,162 @@
+# Channels derived from the raw telemetry of a 2D race (time, velocities and
+# accelerations), computed in one pass over whole columns after the run instead
+# of on every step of the simulation. Uses NumPy if it's installed.
+#
+# For example:
+#   channels = calculate_derived_channels(log.column("t"), log.column("vx"), log.column("vy"),
+#                                         log.column("ax"), log.column("ay"), MAX_TRACTION)
+#   for name, column in channels.items():
+#       log.add_channel(name, column)
+
+import array
+import math
+import unittest
+
+# Returns a dict of columns (as array('d')):
+#   speed: m/s.
+#   long_g, lat_g: the accelerations along and across the direction of travel,
+#     m/s^2, NaN when standing still.
+#   line_curvature: 1000 / the radius of the line, 1000/m.
+#   distance: from the first data point, m. Integrates the speed with the
+#     trapezoidal rule, corrected with long_g (the derivative of the speed), so
+#     it stays precise with few data points.
+#   jerk: how fast the acceleration changes, m/s^3.
+#   traction_utilization: the share of max_traction used, if max_traction is
+#     given.
+def calculate_derived_channels(t, vx, vy, ax, ay, max_traction = None):
+    try:
+        import numpy
+    except ModuleNotFoundError:
+        return calculate_derived_channels_python(t, vx, vy, ax, ay, max_traction)
+
+    t, vx, vy, ax, ay = (numpy.asarray(column, dtype = numpy.float64) for column in (t, vx, vy, ax, ay))
+    speed = numpy.sqrt(vx * vx + vy * vy)
+    with numpy.errstate(divide = "ignore", invalid = "ignore"):
+        moving = speed > 0
+        long_g = numpy.where(moving, (ax * vx + ay * vy) / speed, numpy.nan)
+        lat_g = numpy.where(moving, (ax * vy - ay * vx) / speed, numpy.nan)
+        turning = moving & (lat_g != 0)
+        line_curvature = numpy.where(turning, 1000 / (speed * speed / lat_g), 0)
+
+    slope = numpy.nan_to_num(long_g)
+    distance = numpy.zeros(len(t))
+    if len(t) > 1:
+        dt = numpy.diff(t)
+        distance[1:] = numpy.cumsum(dt * (speed[:-1] + speed[1:]) / 2 + dt * dt * (slope[:-1] - slope[1:]) / 12)
+
+    jerk = numpy.zeros(len(t))
+    if len(t) > 1:
+        jerk = numpy.hypot(numpy.gradient(ax, t), numpy.gradient(ay, t))
+
+    channels = {
+        "speed": speed,
+        "long_g": long_g,
+        "lat_g": lat_g,
+        "line_curvature": line_curvature,
+        "distance": distance,
+        "jerk": jerk,
+    }
+    if max_traction is not None:
+        channels["traction_utilization"] = numpy.hypot(ax, ay) / max_traction
+    return {name: array.array("d", column.tobytes()) for name, column in channels.items()}
+
+# The same without NumPy.
+def calculate_derived_channels_python(t, vx, vy, ax, ay, max_traction = None):
+    n = len(t)
+    channels = {name: array.array("d") for name in ("speed", "long_g", "lat_g", "line_curvature", "distance", "jerk")}
+    if max_traction is not None:
+        channels["traction_utilization"] = array.array("d")
+
+    distance = 0
+    for i in range(n):
+        speed = math.sqrt(vx[i] * vx[i] + vy[i] * vy[i])
+        if speed > 0:
+            long_g = (ax[i] * vx[i] + ay[i] * vy[i]) / speed
+            lat_g = (ax[i] * vy[i] - ay[i] * vx[i]) / speed
+        else:
+            long_g = lat_g = math.nan
+        line_curvature = 1000 / (speed * speed / lat_g) if speed > 0 and lat_g != 0 else 0
+
+        if i > 0:
+            dt = t[i] - t[i - 1]
+            previous_slope = channels["long_g"][i - 1]
+            previous_slope = 0 if math.isnan(previous_slope) else previous_slope
+            slope = 0 if math.isnan(long_g) else long_g
+            distance += dt * (channels["speed"][i - 1] + speed) / 2 + dt * dt * (previous_slope - slope) / 12
+
+        # Central differences, like numpy.gradient with uneven spacing.
+        if n < 2:
+            jerk = 0
+        elif i == 0:
+            jerk = math.hypot((ax[1] - ax[0]) / (t[1] - t[0]), (ay[1] - ay[0]) / (t[1] - t[0]))
+        elif i == n - 1:
+            jerk = math.hypot((ax[i] - ax[i - 1]) / (t[i] - t[i - 1]), (ay[i] - ay[i - 1]) / (t[i] - t[i - 1]))
+        else:
+            h0, h1 = t[i] - t[i - 1], t[i + 1] - t[i]
+            gradient = lambda f: (h0 * h0 * f[i + 1] + (h1 * h1 - h0 * h0) * f[i] - h1 * h1 * f[i - 1]) / (h0 * h1 * (h0 + h1))
+            jerk = math.hypot(gradient(ax), gradient(ay))
+
+        channels["speed"].append(speed)
+        channels["long_g"].append(long_g)
+        channels["lat_g"].append(lat_g)
+        channels["line_curvature"].append(line_curvature)
+        channels["distance"].append(distance)
+        channels["jerk"].append(jerk)
+        if max_traction is not None:
+            channels["traction_utilization"].append(math.hypot(ax[i], ay[i]) / max_traction)
+    return channels
+
+#### Self tests
+
+class TestDerivedChannels(unittest.TestCase):
+
+    def assertChannelsEqual(self, actual, expected):
+        self.assertEqual(list(actual), list(expected))
+        for name in expected:
+            self.assertEqual(len(actual[name]), len(expected[name]), name)
+            for a, e in zip(actual[name], expected[name]):
+                if math.isnan(e):
+                    self.assertTrue(math.isnan(a), name)
+                else:
+                    self.assertAlmostEqual(a, e, delta = 1e-9 * max(1, abs(e)), msg = name)
+
+    def test_circle(self):
+        # 10 m/s on a circle of radius 50 m, counterclockwise, with uneven
+        # time steps.
+        t = [0, 0.1, 0.3, 0.35, 1, 2.5]
+        omega = 10 / 50
+        vx = [-10 * math.sin(omega * ti) for ti in t]
+        vy = [10 * math.cos(omega * ti) for ti in t]
+        ax = [-2 * math.cos(omega * ti) for ti in t]
+        ay = [-2 * math.sin(omega * ti) for ti in t]
+        channels = calculate_derived_channels_python(t, vx, vy, ax, ay, 4)
+        for i in range(len(t)):
+            self.assertAlmostEqual(channels["speed"][i], 10)
+            self.assertAlmostEqual(channels["long_g"][i], 0)
+            self.assertAlmostEqual(abs(channels["lat_g"][i]), 2)
+            self.assertAlmostEqual(abs(channels["line_curvature"][i]), 1000 / 50)
+            self.assertAlmostEqual(channels["distance"][i], 10 * t[i])
+            self.assertAlmostEqual(channels["traction_utilization"][i], 0.5)
+
+    def test_numpy_matches_python(self):
+        try:
+            import numpy
+        except ModuleNotFoundError:
+            self.skipTest("Needs NumPy")
+        # Starting from standing still (NaN G forces), speeding up and turning,
+        # with uneven time steps.
+        t = [0.01 * i + 0.003 * (i % 3) for i in range(50)]
+        vx = [0] + [5 + math.cos(ti) for ti in t[1:]]
+        vy = [0] + [3 * math.sin(2 * ti) for ti in t[1:]]
+        ax = [1 + ti for ti in t]
+        ay = [math.sin(5 * ti) for ti in t]
+        for max_traction in (None, 10):
+            self.assertChannelsEqual(calculate_derived_channels(t, vx, vy, ax, ay, max_traction),
+                                     calculate_derived_channels_python(t, vx, vy, ax, ay, max_traction))
+        # Too short for differences.
+        for n in (0, 1, 2):
+            self.assertChannelsEqual(calculate_derived_channels(t[:n], vx[:n], vy[:n], ax[:n], ay[:n]),
+                                     calculate_derived_channels_python(t[:n], vx[:n], vy[:n], ax[:n], ay[:n]))
+
+if __name__ == '__main__':
+    unittest.main()
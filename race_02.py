@@ -62,6 +62,28 @@ def my_driver_algorithm(x, v, t):
     else:
         return -1
 
+# Optional: my_driver_segment(x, v, t) lets the simulation skip ahead when you
+# know what your driver is going to do for a while, instead of simulating it
+# step by step. It should describe the same driving as my_driver_algorithm,
+# it's only a way to get the result much faster. The segments end exactly
+# where they should instead of at the next step, so the lap time can be up to
+# one time step (0.001 seconds) quicker than when stepping, e.g. 2.904
+# instead of 2.905 seconds for the naive solution.
+#
+# Returns None to let the simulation call my_driver_algorithm as usual, or
+#   (driver_input, "x", until_x) to hold driver_input until the car reaches
+#     the distance until_x, or
+#   (driver_input, "v", until_v) to hold driver_input until the speed reaches
+#     until_v.
+#
+# Note that the graphs only get one data point per segment.
+def my_driver_segment(x, v, t):
+    # For example, the naive solution above could be described as:
+    #   if x < 69:
+    #       return 1, "x", 69
+    #   return -1, "x", RACE_DISTANCE
+    return None
+
 # # # # # # # # # # # # # # # # # # # # #
  # # # # # # # # FINISH! # # # # # # # # #
 # # # # # # # # # # # # # # # # # # # # #
@@ -83,36 +105,142 @@ def convert_racer_algorithm_to_acceleration(driver_input, v):
         # Braking.
         return driver_input * TRACTION
 
-def calculate_accelerations_p_v_t(positions, velocities, t):
-    x = positions[0]
-    v = velocities[0]
-    return [convert_racer_algorithm_to_acceleration(my_driver_algorithm(x, v, t), v)]
+# Turns a segment returned by my_driver_segment into a closed-form solver
+# segment with the same physics as convert_racer_algorithm_to_acceleration.
+def convert_racer_segment_to_solver_segment(segment, v):
+    driver_input, until, until_value = segment
+    if driver_input > 1:
+        raise Exception(f"Too much throttle requested: {driver_input}")
+    if driver_input < -1:
+        raise Exception(f"Too much braking requested: {driver_input}")
+    if until == "x":
+        end = {"end_position": until_value}
+    elif until == "v":
+        end = {"end_velocity": until_value}
+    else:
+        raise Exception(f"Unknown segment end: {until}")
+
+    if driver_input > 0:
+        if driver_input * POWER > TRACTION * MASS * v:
+            # Traction-limited until the speed gets high enough for the car to
+            # become power-limited.
+            power_limited_speed = driver_input * POWER / (TRACTION * MASS)
+            end["end_velocity"] = min(end.get("end_velocity", power_limited_speed), power_limited_speed)
+            return solver.ConstantAccelerationSegment([TRACTION], **end)
+        return solver.PowerLimitedSegment(driver_input * POWER / MASS, **end)
+    else:
+        return solver.ConstantAccelerationSegment([driver_input * TRACTION], **end)
+
+def calculate_segment_p_v_t(positions, velocities, t):
+    segment = my_driver_segment(positions[0], velocities[0], t)
+    if segment is None:
+        return None
+    return convert_racer_segment_to_solver_segment(segment, velocities[0])
 
-data_log = [
-   ([], "distance, m", "time, sec"),
-   ([], "speed, m/s", "time, sec"),
-   ([], "speed, m/s", "distance, m")
-]
+# The accelerations of the car for the driver input, e.g. the one the solver
+# holds between two samples of the driver (see control_period in RaceSession).
+def calculate_accelerations_p_v_t_u(positions, velocities, t, driver_input):
+    return [convert_racer_algorithm_to_acceleration(driver_input, velocities[0])]
 
-def progress_listener_callback_p_v_t(positions, velocities, t):
+# The rules of the race. Raises an exception if they're broken, and returns
+# True at the finish. The speed at the finish is checked afterwards.
+def check_rules_p_v_t(positions, velocities, t):
     if velocities[0] < 0 and positions[0] < RACE_DISTANCE:
         raise Exception(f"The car went backwards! Position = {positions[0]}, velocity = {velocities[0]}")
+    return positions[0] >= RACE_DISTANCE
 
-    data_log[0][0].append((positions[0], t))
-    data_log[1][0].append((velocities[0], t))
-    data_log[2][0].append((velocities[0], positions[0]))
+# The finish as a solver.Event, to find the lap time between two steps of the
+# simulation instead of at the first step past the finish (see certify.py).
+def make_finish_event():
+    return solver.Event(lambda p, v, t: p[0] - RACE_DISTANCE, direction = 1)
 
-    if positions[0] >= RACE_DISTANCE:
-        return True  # Finished!
-    return False
+# A single run of the race, with its own driver and its own data log. Use a new
+# one for every run; any number of them can run one after another or at the
+# same time in one process.
+# driver_algorithm and initial_speed default to my_driver_algorithm and
+# INITIAL_SPEED.
+# With control_period, the driver is only asked every control_period seconds
+# and its input is held in between, like a real car's ECU does (see
+# solver.solveGeneric). That's faster, but may change the lap time a bit.
+class RaceSession:
+    def __init__(self, driver_algorithm = None, initial_speed = None, control_period = None):
+        self.driver_algorithm = driver_algorithm or my_driver_algorithm
+        self.control_period = control_period
+        # my_driver_segment only describes my_driver_algorithm.
+        self.calculate_segment_p_v_t = None if driver_algorithm else calculate_segment_p_v_t
+        self.initial_positions = [INITIAL_POSITION]
+        self.initial_velocities = [INITIAL_SPEED if initial_speed is None else initial_speed]
+        self.check_rules_p_v_t = check_rules_p_v_t
+        self.data_log = [
+           ([], "distance, m", "time, sec"),
+           ([], "speed, m/s", "time, sec"),
+           ([], "speed, m/s", "distance, m")
+        ]
 
-def main():
-    try:
-        positions, velocities, time = solver.solveRK4(
-            [INITIAL_POSITION], [INITIAL_SPEED],
+    def calculate_accelerations_p_v_t(self, positions, velocities, t):
+        return calculate_accelerations_p_v_t_u(positions, velocities, t, self.driver_algorithm(positions[0], velocities[0], t))
+
+    def calculate_driver_input_p_v_t(self, positions, velocities, t):
+        return self.driver_algorithm(positions[0], velocities[0], t)
+
+    def progress_listener_callback_p_v_t(self, positions, velocities, t):
+        finished = self.check_rules_p_v_t(positions, velocities, t)
+
+        data_log = self.data_log
+        data_log[0][0].append((positions[0], t))
+        data_log[1][0].append((velocities[0], t))
+        data_log[2][0].append((velocities[0], positions[0]))
+
+        return finished
+
+    # Runs the race, filling in the data log. Returns the final (positions,
+    # velocities, time).
+    def run(self, profile = None):
+        calculate_accelerations_p_v_t = self.calculate_accelerations_p_v_t
+        control_function_p_v_t = None
+        if self.control_period:
+            calculate_accelerations_p_v_t = calculate_accelerations_p_v_t_u
+            control_function_p_v_t = self.calculate_driver_input_p_v_t
+        return solver.solveRK4(
+            self.initial_positions, self.initial_velocities,
             calculate_accelerations_p_v_t,
             TIME_LIMIT, 0.001,
-            progress_listener_callback_p_v_t)
+            self.progress_listener_callback_p_v_t,
+            segment_function_p_v_t = self.calculate_segment_p_v_t,
+            control_function_p_v_t = control_function_p_v_t, control_period = self.control_period,
+            profile = profile)
+
+    # Runs the race without logging, printing or plotting, e.g. to try out many
+    # drivers quickly. Returns a RaceResult.
+    def evaluate(self):
+        calculate_accelerations_p_v_t = self.calculate_accelerations_p_v_t
+        control_function_p_v_t = None
+        if self.control_period:
+            calculate_accelerations_p_v_t = calculate_accelerations_p_v_t_u
+            control_function_p_v_t = self.calculate_driver_input_p_v_t
+        result = evaluate_race(
+            lambda listener: solver.solveRK4(
+                self.initial_positions, self.initial_velocities,
+                calculate_accelerations_p_v_t,
+                TIME_LIMIT, 0.001,
+                listener,
+                segment_function_p_v_t = self.calculate_segment_p_v_t,
+                control_function_p_v_t = control_function_p_v_t, control_period = self.control_period),
+            self.check_rules_p_v_t, TIME_LIMIT)
+        if result.finished and result.velocities[0] > MAX_SPEED_AT_FINISH:
+            result = RaceResult(result.time, result.positions, result.velocities,
+                                failure = f"DISQUALIFIED: the speed at the finish was too high ({result.velocities[0]:.2f} m/s)")
+        return result
+
+# Same as RaceSession(driver_algorithm, initial_speed).evaluate().
+def evaluate(driver_algorithm = None, initial_speed = None):
+    return RaceSession(driver_algorithm, initial_speed).evaluate()
+
+def main():
+    profile = create_solver_profile_if_requested(globals(), ["my_driver_algorithm", "convert_racer_algorithm_to_acceleration"])
+    session = RaceSession(control_period = get_control_period_if_requested())
+    try:
+        positions, velocities, time = session.run(profile)
 
         if time < TIME_LIMIT:
             if velocities[0] <= MAX_SPEED_AT_FINISH:
@@ -128,16 +256,19 @@ def main():
             print(f"DNF")
 
     finally:
-        if len(data_log[0][0]):
+        if len(session.data_log[0][0]):
             try:
                 import data_log_plotter
                 graphs_filename = "race_02.png"
-                data_log_plotter.plot_graphs(data_log, graphs_filename)
+                data_log_plotter.plot_graphs(session.data_log, graphs_filename)
                 print(f"Graphs for the data log were rendered to '{graphs_filename}'.")
             except ModuleNotFoundError:
                 print("Unable to plot the graphs, please install Pillow. See README for tips.")
         else:
             print("Warning: no data log collected, not plotting the graphs.")
 
+        if profile:
+            print(profile.report())
+
 if __name__ == '__main__':
     main()
@@ -18,10 +18,14 @@
 RECORD = 6.811
 
 from common import *
+import course
 import math
+import derived_channels
 import solver
+import telemetry
 
 TIME_LIMIT = 20 # seconds.
+TIME_STEP = 0.0001 # seconds.
 
 MAX_TRACTION = 10 # m/s^2.
 
@@ -117,98 +121,188 @@ def normalize_accelerations(ax, ay):
         ay = ay * 0.999
     return (ax, ay)
 
-def calculate_accelerations_p_v_t(positions, velocities, t):
-    ax, ay = my_driver_algorithm(positions[0], positions[1], velocities[0], velocities[1], t)
+# The accelerations of the car for the driver input (ax, ay), e.g. the one the
+# solver holds between two samples of the driver (see control_period in
+# RaceSession).
+def calculate_accelerations_p_v_t_u(positions, velocities, t, driver_input):
+    ax, ay = driver_input
     total = math.sqrt(math.pow(ax, 2) + math.pow(ay, 2))
     ax, ay = normalize_accelerations(ax, ay)
     if ax**2 + ay**2 > MAX_TRACTION**2:
         raise Exception(f"Too much traction demanded: (ax={ax}, ay={ay}, total before normalization={total}")
     return [ax, ay]
 
-data_log = [
-   ([], "y, m", "x, m"),  # TODO force same scale x vs y.
-   ([], "long G, m/s^2", "time, sec"),
-   ([], "lat G, m/s^2", "time, sec"),
-   ([], "speed, m/s", "distance, m"),
-   ([], "long G, m/s^2", "distance, m"),
-   ([], "lat G, m/s^2", "distance, m"),
-   ([], "line curvature, 1000/m", "distance, m"),
-]
-
 INITIAL_POSITION = [INITIAL_X, 0]
-prev_position = INITIAL_POSITION[:]
-distance = 0
-
-def progress_listener_callback_p_v_t(positions, velocities, t):
-    x, y = positions[0], positions[1]
-    if x < 0 or y > 120 or y < 0 or (x > 20 and y < 100):
-        raise Exception(f"Cut the course at (x={x:.3f}, y={y:.3f}), t={t:.3f}")
-
-    global distance
-    global prev_position
-    distance += math.sqrt(math.pow(positions[0] - prev_position[0], 2) + math.pow(positions[1] - prev_position[1], 2))
-    prev_position = positions[:]
-
-    vx, vy = velocities[0], velocities[1]
-    ax, ay = my_driver_algorithm(x, y, vx, vy, t)
-
-    v_total = math.sqrt(math.pow(vx, 2) + math.pow(vy, 2))
-    if v_total > 0:
-        long_g = (ax * vx + ay * vy) / v_total
-        lat_g = (ax * vy - ay * vx) / v_total
-    else:
-        long_g = None
-        lat_g = None
-
-    if lat_g:
-        line_radius = math.pow(v_total, 2) / lat_g
-        line_curvature = 1000 / line_radius
-    else:
-        line_curvature = 0
-
-
-    speed = math.sqrt(math.pow(velocities[0], 2) + math.pow(velocities[1], 2))
-
-    data_log[0][0].append((positions[1], positions[0]))
-    data_log[1][0].append((long_g, t))
-    data_log[2][0].append((lat_g, t))
-    data_log[3][0].append((speed, distance))
-    data_log[4][0].append((long_g, distance))
-    data_log[5][0].append((lat_g, distance))
-    data_log[6][0].append((line_curvature, distance))
-
-    if x >= 120 and y >= 100 and y <= 120:
-        return True  # Finished!
-    return False
+
+# The graphs don't need a data point for every step of the simulation.
+DATA_LOG_PERIOD = 0.01 # seconds.
+
+# The course, see the description at the top.
+COURSE = course.Course(
+    corridors = [course.Corridor(0, 0, 20, 120), course.Corridor(0, 100, math.inf, 120)],
+    finish = course.Gate(120, 100, math.inf, 120))
+
+# The rules of the course. The returned check_rules_p_v_t(positions,
+# velocities, t) raises an exception if they're broken, and returns True at the
+# finish. Every run of the race needs a new one, as it checks the whole way
+# from the previous position of the car.
+def make_check_rules_p_v_t():
+    return COURSE.make_check_rules_p_v_t()
+
+# The finish as a solver.Event, to find the lap time between two steps of the
+# simulation instead of at the first step past the finish (see certify.py).
+def make_finish_event():
+    return solver.Event(lambda p, v, t: COURSE.calculate_distance_outside_finish_p(p), direction = -1)
+
+# Runs of the race with their own driver and their own state (the data log,
+# the distance traveled, ...). Any number of sessions can run one after another
+# or at the same time in one process, and every run() or evaluate() of a
+# session starts over.
+# driver_algorithm, initial_speed and initial_x default to my_driver_algorithm,
+# INITIAL_SPEED and INITIAL_X.
+# With control_period, the driver is only asked every control_period seconds
+# and its input is held in between, like a real car's ECU does (see
+# solver.solveGeneric). That's faster, but may change the lap time a bit.
+class RaceSession:
+    def __init__(self, driver_algorithm = None, initial_speed = None, initial_x = None, control_period = None):
+        self.driver_algorithm = driver_algorithm or my_driver_algorithm
+        self.control_period = control_period
+        self.initial_positions = [INITIAL_X if initial_x is None else initial_x, 0]
+        self.initial_velocities = [0, INITIAL_SPEED if initial_speed is None else initial_speed]
+        self.start_run()
+
+    # Gets ready for a new run: a new rules check, as it remembers where the
+    # car was, and an empty data log.
+    def start_run(self):
+        self.check_rules_p_v_t = make_check_rules_p_v_t()
+        # Only the raw state is logged during the run, the rest of the channels
+        # are derived from it afterwards, see calculate_derived_channels.
+        self.telemetry = telemetry.TelemetryLog(["t", "x", "y", "vx", "vy", "ax", "ay"])
+        self.data_log = self.telemetry.data_log([
+           ("y", "x", "y, m", "x, m"),  # TODO force same scale x vs y.
+           ("long_g", "t", "long G, m/s^2", "time, sec"),
+           ("lat_g", "t", "lat G, m/s^2", "time, sec"),
+           ("speed", "distance", "speed, m/s", "distance, m"),
+           ("long_g", "distance", "long G, m/s^2", "distance, m"),
+           ("lat_g", "distance", "lat G, m/s^2", "distance, m"),
+           ("line_curvature", "distance", "line curvature, 1000/m", "distance, m"),
+        ])
+        self.distance = 0
+
+    def calculate_accelerations_p_v_t(self, positions, velocities, t):
+        return calculate_accelerations_p_v_t_u(positions, velocities, t, self.driver_algorithm(positions[0], positions[1], velocities[0], velocities[1], t))
+
+    # Same as calculate_accelerations_p_v_t, but also returns the driver input
+    # so that it ends up in the solver's step records (see solver.StepRecord).
+    def calculate_accelerations_and_driver_input_p_v_t(self, positions, velocities, t):
+        driver_input = self.driver_algorithm(positions[0], positions[1], velocities[0], velocities[1], t)
+        return calculate_accelerations_p_v_t_u(positions, velocities, t, driver_input), driver_input
+
+    def calculate_driver_input_p_v_t(self, positions, velocities, t):
+        return self.driver_algorithm(positions[0], positions[1], velocities[0], velocities[1], t)
+
+    # Same as calculate_accelerations_and_driver_input_p_v_t, with the driver
+    # input held by the solver, see control_period.
+    def calculate_accelerations_and_held_driver_input_p_v_t_u(self, positions, velocities, t, driver_input):
+        return calculate_accelerations_p_v_t_u(positions, velocities, t, driver_input), driver_input
+
+    def progress_listener_callback_step(self, step):
+        positions, velocities, t = step.positions, step.velocities, step.t
+        return self.check_rules_p_v_t(positions, velocities, t)
+
+    # Called every DATA_LOG_PERIOD seconds, after the progress listener.
+    def log_data_step(self, step):
+        positions, velocities = step.positions, step.velocities
+        # The solver already asked the driver at this point, no need to do it again.
+        ax, ay = step.aux
+        self.telemetry.append(step.t, positions[0], positions[1], velocities[0], velocities[1], ax, ay)
+
+    # Adds the channels for the graphs to the telemetry, and sets the distance
+    # traveled.
+    def calculate_derived_channels(self):
+        log = self.telemetry
+        channels = derived_channels.calculate_derived_channels(log.column("t"), log.column("vx"), log.column("vy"),
+                                                               log.column("ax"), log.column("ay"), MAX_TRACTION)
+        for name, column in channels.items():
+            log.add_channel(name, column)
+        self.distance = log.column("distance")[-1] if len(log) else 0
+
+    # Runs the race, filling in the data log. Returns the final (positions,
+    # velocities, time).
+    def run(self, profile = None):
+        self.start_run()
+        calculate_accelerations_p_v_t = self.calculate_accelerations_and_driver_input_p_v_t
+        control_function_p_v_t = None
+        if self.control_period:
+            calculate_accelerations_p_v_t = self.calculate_accelerations_and_held_driver_input_p_v_t_u
+            control_function_p_v_t = self.calculate_driver_input_p_v_t
+        try:
+            positions, velocities, time = solver.solveRK4(
+                self.initial_positions, self.initial_velocities,
+                calculate_accelerations_p_v_t,
+                TIME_LIMIT, TIME_STEP,
+                self.progress_listener_callback_step,
+                control_function_p_v_t = control_function_p_v_t, control_period = self.control_period,
+                step_records = True, accelerations_aux = True,
+                observers = [solver.Observer(self.log_data_step, period = DATA_LOG_PERIOD)],
+                profile = profile)
+            return positions, velocities, time
+        finally:
+            self.calculate_derived_channels()
+
+    # Runs the race without logging, printing or plotting, e.g. to try out many
+    # drivers quickly. Returns a RaceResult.
+    def evaluate(self):
+        self.check_rules_p_v_t = make_check_rules_p_v_t()
+        calculate_accelerations_p_v_t = self.calculate_accelerations_p_v_t
+        control_function_p_v_t = None
+        if self.control_period:
+            calculate_accelerations_p_v_t = calculate_accelerations_p_v_t_u
+            control_function_p_v_t = self.calculate_driver_input_p_v_t
+        return evaluate_race(
+            lambda listener: solver.solveRK4(
+                self.initial_positions, self.initial_velocities,
+                calculate_accelerations_p_v_t,
+                TIME_LIMIT, TIME_STEP,
+                listener,
+                control_function_p_v_t = control_function_p_v_t, control_period = self.control_period),
+            self.check_rules_p_v_t, TIME_LIMIT)
+
+# Same as RaceSession(driver_algorithm, initial_speed, initial_x).evaluate().
+def evaluate(driver_algorithm = None, initial_speed = None, initial_x = None):
+    return RaceSession(driver_algorithm, initial_speed, initial_x).evaluate()
 
 def main():
+    profile = create_solver_profile_if_requested(globals(), ["my_driver_algorithm", "normalize_accelerations"])
+    session = RaceSession(control_period = get_control_period_if_requested())
     try:
-        positions, velocities, time = solver.solveRK4(
-            INITIAL_POSITION, [0, INITIAL_SPEED],
-            calculate_accelerations_p_v_t,
-            TIME_LIMIT, 0.0001,
-            progress_listener_callback_p_v_t)
+        positions, velocities, time = session.run(profile)
 
         if time < TIME_LIMIT:
             print(f"Finished in {time:.3f} seconds.")
             compare_lap_time_with_record_and_reference(time, RECORD, 8.219)
-            print(f"Distance traveled: {distance:.3f} meters.")
+            print(f"Distance traveled: {session.distance:.3f} meters.")
         else:
             print(f"DNF")
 
+        save_telemetry_if_requested("race_05", session, time if time < TIME_LIMIT else None, TIME_STEP)
+
     finally:
         # TODO: draw a map with obstacles.
 
-        if len(data_log[0][0]):
+        if len(session.data_log[0][0]):
             try:
                 import data_log_plotter
                 graphs_filename = "race_05.png"
-                data_log_plotter.plot_graphs(data_log, graphs_filename)
+                data_log_plotter.plot_graphs(session.data_log, graphs_filename)
                 print(f"Graphs for the data log were rendered to '{graphs_filename}'.")
             except ModuleNotFoundError:
                 print("Unable to plot the graphs, please install Pillow. See README for tips.")
         else:
             print("Warning: no data log collected, not plotting the graphs.")
 
+        if profile:
+            print(profile.report())
+
 if __name__ == '__main__':
     main()
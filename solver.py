@@ -1,5 +1,9 @@
+import bisect
+import copy
 import math
+import os
 import unittest
+from time import perf_counter
 
 # Iteration functions
 
@@ -46,32 +50,1081 @@ def calculateNextStateRK4(positions, velocities, t, accelerationsFunction, delta
         yf[i] += delta_t * (k1[i] + 2 * k2[i] + 2 * k3[i] + k4[i]) / 6
     return yf[:len(positions)], yf[len(positions):]
 
+def makeNextStateRK4InPlace(dimension):
+    # Returns a step function with the same stages and the same results as
+    # calculateNextStateRK4, but which updates the positions and velocities
+    # lists in place and reuses preallocated stage buffers instead of building
+    # new lists for every stage. Use it with solveGeneric(..., in_place=True).
+    #
+    # The buffers are plain lists rather than array('d'): reading from an array
+    # creates a new float object every time, which makes it slower in CPython.
+    stage_positions = [0.0] * dimension
+    stage_velocities = [0.0] * dimension
+    k2_positions = [0.0] * dimension
+    k2_velocities = [0.0] * dimension
+    sum_positions = [0.0] * dimension
+    sum_velocities = [0.0] * dimension
+    indices = range(dimension)
+
+    def calculateNextStateRK4InPlace(positions, velocities, t, accelerationsFunction, delta_t):
+        half_delta_t = 0.5 * delta_t
+
+        k_velocities = accelerationsFunction(positions, velocities, t)
+        for i in indices:
+            sum_positions[i] = velocities[i]
+            sum_velocities[i] = k_velocities[i]
+            stage_positions[i] = positions[i] + half_delta_t * velocities[i]
+            stage_velocities[i] = velocities[i] + half_delta_t * k_velocities[i]
+
+        k_velocities = accelerationsFunction(stage_positions, stage_velocities, t + delta_t * 0.5)
+        for i in indices:
+            k2_positions[i] = stage_velocities[i]
+            k2_velocities[i] = k_velocities[i]
+            sum_positions[i] += 2 * stage_velocities[i]
+            sum_velocities[i] += 2 * k_velocities[i]
+            stage_positions[i] = positions[i] + half_delta_t * k2_positions[i]
+            stage_velocities[i] = velocities[i] + half_delta_t * k2_velocities[i]
+
+        k_velocities = accelerationsFunction(stage_positions, stage_velocities, t + delta_t * 0.5)
+        for i in indices:
+            sum_positions[i] += 2 * stage_velocities[i]
+            sum_velocities[i] += 2 * k_velocities[i]
+            # Mirrors calculateNextStateRK4, which builds the last stage from k2.
+            stage_positions[i] = positions[i] + delta_t * k2_positions[i]
+            stage_velocities[i] = velocities[i] + delta_t * k2_velocities[i]
+
+        k_velocities = accelerationsFunction(stage_positions, stage_velocities, t + delta_t)
+        for i in indices:
+            sum_positions[i] += stage_velocities[i]
+            sum_velocities[i] += k_velocities[i]
+            positions[i] += delta_t * sum_positions[i] / 6
+            velocities[i] += delta_t * sum_velocities[i] / 6
+        return positions, velocities
+
+    return calculateNextStateRK4InPlace
+
+# Generated step functions
+#
+# The races only use one or two dimensions, so most of the per-step cost of the
+# generic functions above is the Python interpreter going through the loops and
+# slices. getUnrolledNextStateFunction() generates a step function for a fixed
+# dimension with all of that unrolled into local variables. The arithmetic is
+# the same, so the results are identical.
+
+unrolled_next_state_functions = {}
+
+def getUnrolledNextStateFunction(method, dimension):
+    # method is "euler" or "rk4". The result has the same signature as
+    # calculateNextStateEuler/calculateNextStateRK4 and is cached.
+    key = (method, dimension)
+    if key not in unrolled_next_state_functions:
+        if method == "euler":
+            source = generateUnrolledEulerSource(dimension)
+        elif method == "rk4":
+            source = generateUnrolledRK4Source(dimension)
+        else:
+            raise Exception(f"Unknown method: {method}")
+        namespace = {}
+        exec(compile(source, f"<unrolled {method} step, dimension {dimension}>", "exec"), namespace)
+        unrolled_next_state_functions[key] = namespace["calculateNextState"]
+    return unrolled_next_state_functions[key]
+
+def generateUnrolledEulerSource(dimension):
+    indices = range(dimension)
+    lines = ["def calculateNextState(positions, velocities, t, accelerationsFunction, delta_t):"]
+    lines.append("    a = accelerationsFunction(positions, velocities, t)")
+    lines.append("    return [" + ", ".join(f"positions[{i}] + delta_t * velocities[{i}]" for i in indices) + "], "
+                 + "[" + ", ".join(f"velocities[{i}] + delta_t * a[{i}]" for i in indices) + "]")
+    return "\n".join(lines) + "\n"
+
+def generateUnrolledRK4Source(dimension):
+    # Mirrors calculateNextStateRK4 stage by stage, including building the last
+    # stage from k2.
+    indices = range(dimension)
+    def join(template):
+        return ", ".join(template.format(i = i) for i in indices)
+    def assign(names, template):
+        lines.append(f"    {join(names)} = {join(template)}")
+
+    lines = ["def calculateNextState(positions, velocities, t, accelerationsFunction, delta_t):"]
+    assign("p{i}", "positions[{i}]")
+    assign("v{i}", "velocities[{i}]")
+    lines.append("    half_delta_t = 0.5 * delta_t")
+
+    lines.append("    a = accelerationsFunction(positions, velocities, t)")
+    assign("k1p{i}", "v{i}")
+    assign("k1v{i}", "a[{i}]")
+
+    assign("y1p{i}", "p{i} + half_delta_t * k1p{i}")
+    assign("y1v{i}", "v{i} + half_delta_t * k1v{i}")
+    lines.append(f"    a = accelerationsFunction([{join('y1p{i}')}], [{join('y1v{i}')}], t + delta_t * 0.5)")
+    assign("k2p{i}", "y1v{i}")
+    assign("k2v{i}", "a[{i}]")
+
+    assign("y2p{i}", "p{i} + half_delta_t * k2p{i}")
+    assign("y2v{i}", "v{i} + half_delta_t * k2v{i}")
+    lines.append(f"    a = accelerationsFunction([{join('y2p{i}')}], [{join('y2v{i}')}], t + delta_t * 0.5)")
+    assign("k3p{i}", "y2v{i}")
+    assign("k3v{i}", "a[{i}]")
+
+    assign("y3p{i}", "p{i} + delta_t * k2p{i}")
+    assign("y3v{i}", "v{i} + delta_t * k2v{i}")
+    lines.append(f"    a = accelerationsFunction([{join('y3p{i}')}], [{join('y3v{i}')}], t + delta_t)")
+    assign("k4p{i}", "y3v{i}")
+    assign("k4v{i}", "a[{i}]")
+
+    lines.append("    return ("
+                 + f"[{join('p{i} + delta_t * (k1p{i} + 2 * k2p{i} + 2 * k3p{i} + k4p{i}) / 6')}], "
+                 + f"[{join('v{i} + delta_t * (k1v{i} + 2 * k2v{i} + 2 * k3v{i} + k4v{i}) / 6')}])")
+    return "\n".join(lines) + "\n"
+
+# Symplectic integrators
+#
+# These only conserve energy (up to a bounded oscillation) when the
+# accelerations depend on the positions alone, e.g. for the pendulum tests.
+# They still work for velocity-dependent accelerations, just without that
+# guarantee.
+
+def makeNextStateVelocityVerlet():
+    # See https://en.wikipedia.org/wiki/Verlet_integration#Velocity_Verlet
+    #
+    # The accelerations at the end of a step are also the accelerations at the
+    # start of the next one, so the returned step function remembers them and
+    # only calls accelerationsFunction once per step. That's why this is a
+    # factory: use a new step function for every simulation.
+    last_positions = None
+    last_time = None
+    last_accelerations = None
+
+    def calculateNextStateVelocityVerlet(positions, velocities, t, accelerationsFunction, delta_t):
+        nonlocal last_positions, last_time, last_accelerations
+        if positions is last_positions and t == last_time:
+            accelerations = last_accelerations
+        else:
+            accelerations = accelerationsFunction(positions, velocities, t)
+
+        half_step_velocities = []
+        next_positions = []
+        for i in range(len(positions)):
+            half_step_velocities.append(velocities[i] + 0.5 * delta_t * accelerations[i])
+            next_positions.append(positions[i] + delta_t * half_step_velocities[i])
+
+        next_accelerations = accelerationsFunction(next_positions, half_step_velocities, t + delta_t)
+        next_velocities = []
+        for i in range(len(positions)):
+            next_velocities.append(half_step_velocities[i] + 0.5 * delta_t * next_accelerations[i])
+
+        last_positions = next_positions
+        last_time = t + delta_t
+        last_accelerations = next_accelerations
+        return next_positions, next_velocities
+
+    return calculateNextStateVelocityVerlet
+
+# Yoshida's 4th order composition of three leapfrog steps, see
+# https://en.wikipedia.org/wiki/Leapfrog_integration#Yoshida_algorithms
+YOSHIDA_W1 = 1 / (2 - math.pow(2, 1 / 3))
+YOSHIDA_W0 = -math.pow(2, 1 / 3) * YOSHIDA_W1
+YOSHIDA_C = [YOSHIDA_W1 / 2, (YOSHIDA_W0 + YOSHIDA_W1) / 2, (YOSHIDA_W0 + YOSHIDA_W1) / 2, YOSHIDA_W1 / 2]
+YOSHIDA_D = [YOSHIDA_W1, YOSHIDA_W0, YOSHIDA_W1]
+
+def calculateNextStateYoshida4(positions, velocities, t, accelerationsFunction, delta_t):
+    # Three acceleration evaluations per step, compared to four for RK4.
+    positions = positions[:]
+    velocities = velocities[:]
+    stage_time = t
+    for stage in range(4):
+        for i in range(len(positions)):
+            positions[i] += YOSHIDA_C[stage] * delta_t * velocities[i]
+        stage_time += YOSHIDA_C[stage] * delta_t
+        if stage < 3:
+            accelerations = accelerationsFunction(positions, velocities, stage_time)
+            for i in range(len(velocities)):
+                velocities[i] += YOSHIDA_D[stage] * delta_t * accelerations[i]
+    return positions, velocities
+
+# Dormand-Prince coefficients, see
+# https://en.wikipedia.org/wiki/Dormand%E2%80%93Prince_method
+# The last row of DORMAND_PRINCE_A doubles as the 5th order solution weights,
+# so the last stage is evaluated at the new state and can be reused as the
+# first stage of the next step ("first same as last").
+DORMAND_PRINCE_C = [0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1, 1]
+DORMAND_PRINCE_A = [
+    [],
+    [1 / 5],
+    [3 / 40, 9 / 40],
+    [44 / 45, -56 / 15, 32 / 9],
+    [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+    [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656],
+    [35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84],
+]
+# Difference between the 5th and the 4th order solution weights.
+DORMAND_PRINCE_E = [71 / 57600, 0, -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525, -1 / 40]
+
+def calculateNextStateRK45(positions, velocities, t, accelerationsFunction, delta_t, k1 = None):
+    # Unlike the fixed-step functions above, this also returns the local error
+    # estimate for every state component and the derivative at the new state,
+    # which can be passed back as k1 for the next step.
+    f = lambda y, t: y[len(positions):] + accelerationsFunction(y[:len(positions)], y[len(positions):], t)
+
+    y0 = positions + velocities
+
+    k = [k1 if k1 is not None else f(y0, t)]
+    for stage in range(1, 7):
+        y = y0[:]
+        for j in range(stage):
+            a = DORMAND_PRINCE_A[stage][j]
+            if a != 0:
+                for i in range(len(y)):
+                    y[i] += delta_t * a * k[j][i]
+        k.append(f(y, t + delta_t * DORMAND_PRINCE_C[stage]))
+
+    error = [0] * len(y0)
+    for j in range(7):
+        e = DORMAND_PRINCE_E[j]
+        if e != 0:
+            for i in range(len(error)):
+                error[i] += delta_t * e * k[j][i]
+
+    return y[:len(positions)], y[len(positions):], error, k[6]
+
+def calculateNextStateRK4Batch(positions, velocities, t, accelerationsFunction, delta_t):
+    # The same stages as calculateNextStateRK4, written for (N, D) arrays with
+    # the position and velocity halves of the state kept separately.
+    k1_p = velocities
+    k1_v = accelerationsFunction(positions, velocities, t)
+
+    k2_p = velocities + 0.5 * delta_t * k1_v
+    k2_v = accelerationsFunction(positions + 0.5 * delta_t * k1_p, k2_p, t + delta_t * 0.5)
+
+    k3_p = velocities + 0.5 * delta_t * k2_v
+    k3_v = accelerationsFunction(positions + 0.5 * delta_t * k2_p, k3_p, t + delta_t * 0.5)
+
+    # Mirrors calculateNextStateRK4, which builds the last stage from k2.
+    k4_p = velocities + delta_t * k2_v
+    k4_v = accelerationsFunction(positions + delta_t * k2_p, k4_p, t + delta_t)
+
+    next_positions = positions + delta_t * (k1_p + 2 * k2_p + 2 * k3_p + k4_p) / 6
+    next_velocities = velocities + delta_t * (k1_v + 2 * k2_v + 2 * k3_v + k4_v) / 6
+    return next_positions, next_velocities
+
+# Events
+#
+# An event fires when its function crosses zero between two consecutive steps.
+# The crossing is located on the cubic Hermite interpolant of the step, so the
+# event time and state are precise regardless of the time step.
+
+class Event:
+    def __init__(self, function_p_v_t, direction = 0, terminal = True, condition_p_v_t = None, callback_p_v_t = None):
+        # function_p_v_t(positions, velocities, t) returns a number.
+        # direction: 1 to only fire when going from negative to positive, -1 for
+        #   the opposite, 0 for both.
+        # terminal: whether the simulation ends at the event.
+        # condition_p_v_t(positions, velocities, t): if set, a crossing only
+        #   counts when this is true at the crossing state (e.g. "y < 0" for a
+        #   finish gate along x = 210).
+        # callback_p_v_t(positions, velocities, t): called with the state at
+        #   the event.
+        self.function_p_v_t = function_p_v_t
+        self.direction = direction
+        self.terminal = terminal
+        self.condition_p_v_t = condition_p_v_t
+        self.callback_p_v_t = callback_p_v_t
+
+def interpolateStateHermite(positions0, velocities0, t0, positions1, velocities1, t1, t):
+    # Cubic Hermite interpolation of the positions between two steps, using
+    # the velocities as the derivatives. The velocities are the derivative of
+    # that cubic, so no extra acceleration evaluations are needed.
+    h = t1 - t0
+    s = (t - t0) / h
+    h00 = 2 * s**3 - 3 * s**2 + 1
+    h10 = s**3 - 2 * s**2 + s
+    h01 = -2 * s**3 + 3 * s**2
+    h11 = s**3 - s**2
+    dh00 = (6 * s**2 - 6 * s) / h
+    dh10 = 3 * s**2 - 4 * s + 1
+    dh01 = (-6 * s**2 + 6 * s) / h
+    dh11 = 3 * s**2 - 2 * s
+    positions = []
+    velocities = []
+    for i in range(len(positions0)):
+        positions.append(h00 * positions0[i] + h10 * h * velocities0[i] + h01 * positions1[i] + h11 * h * velocities1[i])
+        velocities.append(dh00 * positions0[i] + dh10 * velocities0[i] + dh01 * positions1[i] + dh11 * velocities1[i])
+    return positions, velocities
+
+def evaluateEvents(events, positions, velocities, t):
+    return [event.function_p_v_t(positions, velocities, t) for event in events]
+
+def eventCrossesZero(direction, value0, value1):
+    if direction >= 0 and value0 < 0 and value1 >= 0:
+        return True
+    if direction <= 0 and value0 > 0 and value1 <= 0:
+        return True
+    return False
+
+def locateEventTime(function_p_v_t, value0, value1, t0, t1, interpolate_state_t, time_tolerance = 1e-12):
+    # Illinois variant of regula falsi on the interpolated state. Returns the
+    # end of the final bracket that is past the crossing.
+    if value0 < 0:
+        crossed = lambda value: value >= 0
+    else:
+        crossed = lambda value: value <= 0
+    a, b = t0, t1
+    value_a, value_b = value0, value1
+    side = 0
+    for _ in range(100):
+        if abs(b - a) <= time_tolerance or value_b == 0:
+            break
+        t = b - value_b * (b - a) / (value_b - value_a)
+        if not (min(a, b) < t < max(a, b)):
+            t = 0.5 * (a + b)
+        positions, velocities = interpolate_state_t(t)
+        value = function_p_v_t(positions, velocities, t)
+        if crossed(value):
+            b, value_b = t, value
+            if side == -1:
+                value_a *= 0.5
+            side = -1
+        else:
+            a, value_a = t, value
+            if side == 1:
+                value_b *= 0.5
+            side = 1
+    positions, velocities = interpolate_state_t(b)
+    return positions, velocities, b
+
+def handleEvents(events, values0, values1, positions0, velocities0, t0, positions1, velocities1, t1, interpolate_state_t = None):
+    # Fires the callbacks of all events that happened during the step, in time
+    # order, up to the first terminal one. Returns the (positions, velocities, t)
+    # of that terminal event, or None. When integrating backwards in time
+    # (t1 < t0), "in time order" means from t0 backwards.
+    #
+    # interpolate_state_t(t) returns the (positions, velocities) within the
+    # step; by default it's the Hermite interpolant.
+    if not interpolate_state_t:
+        interpolate_state_t = lambda t: interpolateStateHermite(positions0, velocities0, t0, positions1, velocities1, t1, t)
+    occurrences = []
+    for i in range(len(events)):
+        event = events[i]
+        if not eventCrossesZero(event.direction, values0[i], values1[i]):
+            continue
+        positions, velocities, t = locateEventTime(event.function_p_v_t, values0[i], values1[i], t0, t1, interpolate_state_t)
+        if event.condition_p_v_t and not event.condition_p_v_t(positions, velocities, t):
+            continue
+        occurrences.append((t, i, positions, velocities))
+
+    occurrences.sort(key = lambda occurrence: (abs(occurrence[0] - t0), occurrence[1]))
+    for t, i, positions, velocities in occurrences:
+        event = events[i]
+        if event.callback_p_v_t:
+            event.callback_p_v_t(positions, velocities, t)
+        if event.terminal:
+            return positions, velocities, t
+    return None
+
+# Closed-form segments
+#
+# For some control laws the motion has an analytic solution, so there's no need
+# to integrate it step by step. A segment describes such a control law together
+# with when it ends, and solveGeneric jumps straight to that end.
+#
+# Every segment type provides:
+#   timeToEnd(positions, velocities, t): time until the segment ends (may be
+#     math.inf),
+#   propagate(positions, velocities, t, delta_t): the state after delta_t,
+#   snapToEnd(positions, velocities): the state at the end, with the
+#     quantity that ended the segment set exactly to its target value, so
+#     that rounding errors don't leave the driver just short of it.
+
+def timeToReachConstantAcceleration(distance, velocity, acceleration):
+    # The smallest non-negative tau with velocity * tau + acceleration * tau^2 / 2 = distance.
+    if acceleration == 0:
+        if velocity != 0 and distance / velocity >= 0:
+            return distance / velocity
+        return math.inf
+    discriminant = velocity**2 + 2 * acceleration * distance
+    if discriminant < 0:
+        return math.inf
+    # Numerically stable form of the quadratic formula.
+    q = -0.5 * (velocity + math.copysign(math.sqrt(discriminant), velocity))
+    roots = [-distance / q if q != 0 else math.inf, q / (0.5 * acceleration)]
+    roots = [root for root in roots if root >= 0]
+    return min(roots) if roots else math.inf
+
+class ConstantAccelerationSegment:
+    def __init__(self, accelerations, end_time = None, end_position = None, end_velocity = None, axis = 0):
+        # Ends at the earliest of: time reaching end_time, positions[axis]
+        # reaching end_position, velocities[axis] reaching end_velocity.
+        self.accelerations = accelerations
+        self.end_time = end_time
+        self.end_position = end_position
+        self.end_velocity = end_velocity
+        self.axis = axis
+        self.ended_by = None
+
+    def timeToEnd(self, positions, velocities, t):
+        times = {"time": math.inf, "position": math.inf, "velocity": math.inf}
+        if self.end_time is not None:
+            times["time"] = max(0, self.end_time - t)
+        a = self.accelerations[self.axis]
+        if self.end_position is not None:
+            times["position"] = timeToReachConstantAcceleration(self.end_position - positions[self.axis], velocities[self.axis], a)
+        if self.end_velocity is not None and a != 0 and (self.end_velocity - velocities[self.axis]) / a >= 0:
+            times["velocity"] = (self.end_velocity - velocities[self.axis]) / a
+        self.ended_by = min(times, key = times.get)
+        return times[self.ended_by]
+
+    def propagate(self, positions, velocities, t, delta_t):
+        next_positions = []
+        next_velocities = []
+        for i in range(len(positions)):
+            next_positions.append(positions[i] + velocities[i] * delta_t + 0.5 * self.accelerations[i] * delta_t**2)
+            next_velocities.append(velocities[i] + self.accelerations[i] * delta_t)
+        return next_positions, next_velocities
+
+    def snapToEnd(self, positions, velocities):
+        if self.ended_by == "position":
+            positions[self.axis] = self.end_position
+        elif self.ended_by == "velocity":
+            velocities[self.axis] = self.end_velocity
+        return positions, velocities
+
+class PowerLimitedSegment:
+    def __init__(self, power_per_mass, end_time = None, end_position = None, end_velocity = None):
+        # 1D motion at constant power: power_per_mass = v * dv/dt, so
+        #   v(t) = sqrt(v0^2 + 2 * power_per_mass * t),
+        #   x(t) = x0 + (v(t)^3 - v0^3) / (3 * power_per_mass).
+        # The speed must be positive for this to make sense.
+        self.power_per_mass = power_per_mass
+        self.end_time = end_time
+        self.end_position = end_position
+        self.end_velocity = end_velocity
+        self.ended_by = None
+
+    def timeToEnd(self, positions, velocities, t):
+        times = {"time": math.inf, "position": math.inf, "velocity": math.inf}
+        k = self.power_per_mass
+        v = velocities[0]
+        if self.end_time is not None:
+            times["time"] = max(0, self.end_time - t)
+        if self.end_position is not None and self.end_position >= positions[0]:
+            end_v = math.pow(v**3 + 3 * k * (self.end_position - positions[0]), 1 / 3)
+            times["position"] = (end_v**2 - v**2) / (2 * k)
+        if self.end_velocity is not None and self.end_velocity >= v:
+            times["velocity"] = (self.end_velocity**2 - v**2) / (2 * k)
+        self.ended_by = min(times, key = times.get)
+        return times[self.ended_by]
+
+    def propagate(self, positions, velocities, t, delta_t):
+        k = self.power_per_mass
+        v = velocities[0]
+        next_v = math.sqrt(v**2 + 2 * k * delta_t)
+        return [positions[0] + (next_v**3 - v**3) / (3 * k)], [next_v]
+
+    def snapToEnd(self, positions, velocities):
+        if self.ended_by == "position":
+            positions[0] = self.end_position
+        elif self.ended_by == "velocity":
+            velocities[0] = self.end_velocity
+        return positions, velocities
+
+# Profiling
+#
+# Pass a SolverProfile to solveGeneric/solveRK4 to find out where a slow race
+# spends its time. The solver then times every call to the accelerations
+# function, the progress listener and the step function. Anything else can be
+# timed too by wrapping it with profile.wrap(name, function), e.g. the driver.
+# Nested calls are accounted for, so the "self" time of the step function is
+# the integrator arithmetic alone, without the accelerations function.
+#
+# Without a profile, nothing gets wrapped, so there's no overhead.
+
+class SolverProfile:
+    def __init__(self):
+        self.calls = {}
+        self.total_times = {}
+        self.self_times = {}
+        self.wall_time = 0
+        self.num_steps = 0
+        # The time spent in the nested profiled calls, for each call in
+        # progress.
+        self.child_times = []
+
+    def wrap(self, name, function):
+        self.calls.setdefault(name, 0)
+        self.total_times.setdefault(name, 0)
+        self.self_times.setdefault(name, 0)
+        def profiled_function(*args, **kwargs):
+            self.child_times.append(0)
+            start_time = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = perf_counter() - start_time
+                self.calls[name] += 1
+                self.total_times[name] += elapsed
+                self.self_times[name] += elapsed - self.child_times.pop()
+                if self.child_times:
+                    self.child_times[-1] += elapsed
+        # So that e.g. inspect.getsource still finds the original function.
+        profiled_function.__wrapped__ = function
+        return profiled_function
+
+    def report(self):
+        steps_per_second = self.num_steps / self.wall_time if self.wall_time > 0 else 0
+        percent = lambda seconds: 100 * seconds / self.wall_time if self.wall_time > 0 else 0
+        width = max([len(name) for name in self.calls] + [len("(solver loop)")]) + 2
+        lines = [f"Solver profile: {self.num_steps} steps in {self.wall_time:.3f} seconds ({steps_per_second:.0f} steps/second).",
+                 f"  {'':<{width}}{'calls':>10}{'total, s':>10}{'self, s':>10}{'self, %':>9}"]
+        for name in sorted(self.calls, key = lambda name: -self.self_times[name]):
+            lines.append(f"  {name:<{width}}{self.calls[name]:>10}{self.total_times[name]:>10.3f}{self.self_times[name]:>10.3f}{percent(self.self_times[name]):>8.1f}%")
+        # Everything else: the loop itself, events, copying the state, etc.
+        other_time = self.wall_time - sum(self.self_times.values())
+        lines.append(f"  {'(solver loop)':<{width}}{'':>10}{'':>10}{other_time:>10.3f}{percent(other_time):>8.1f}%")
+        return "\n".join(lines)
+
+# Step records
+#
+# With step_records = True, solveGeneric calls the progress listener with a
+# StepRecord instead of (positions, velocities, t). Besides the state, it has
+# the accelerations at that state, which the solver needs for the next step
+# anyway (k1 in calculateNextStateRK4), so the listener doesn't have to call
+# the driver again to e.g. log the G forces.
+
+class StepRecord:
+    def __init__(self, positions, velocities, t, accelerations, aux = None):
+        self.positions = positions
+        self.velocities = velocities
+        self.t = t
+        self.accelerations = accelerations
+        # Whatever else calculate_accelerations_p_v_t returned, see
+        # makeStepRecorder.
+        self.aux = aux
+
+def makeStepRecorder(calculate_accelerations_p_v_t, accelerations_aux = False):
+    # Returns (accelerations_function, make_step_record_p_v_t).
+    #
+    # If accelerations_aux is True, calculate_accelerations_p_v_t returns
+    # (accelerations, aux) instead of just the accelerations, and aux ends up
+    # in the step records.
+    #
+    # The accelerations function remembers the evaluation for the last record,
+    # so making a record for the state at the start of a step and the first
+    # stage of that step share a single call to calculate_accelerations_p_v_t,
+    # as long as the solver passes the same positions and velocities lists on.
+    # That is only reused once: in-place step functions pass the same stage
+    # lists with new values to later stages at the same time (k2 and k3 of
+    # makeNextStateRK4InPlace), so the identity of the lists isn't enough.
+    last_positions = None
+    last_velocities = None
+    last_time = None
+    last_accelerations = None
+    last_aux = None
+
+    def calculate(positions, velocities, t):
+        nonlocal last_aux
+        if accelerations_aux:
+            accelerations, last_aux = calculate_accelerations_p_v_t(positions, velocities, t)
+            return accelerations
+        return calculate_accelerations_p_v_t(positions, velocities, t)
+
+    def evaluate(positions, velocities, t):
+        nonlocal last_positions, last_velocities
+        if positions is last_positions and velocities is last_velocities and t == last_time:
+            last_positions = last_velocities = None
+            return last_accelerations
+        return calculate(positions, velocities, t)
+
+    def make_step_record_p_v_t(positions, velocities, t):
+        nonlocal last_positions, last_velocities, last_time, last_accelerations
+        last_accelerations = calculate(positions, velocities, t)
+        last_positions, last_velocities, last_time = positions, velocities, t
+        return StepRecord(positions, velocities, t, last_accelerations, last_aux)
+
+    return evaluate, make_step_record_p_v_t
+
+# Observers
+#
+# Instead of a single progress listener that does everything on every step,
+# solveGeneric can take a list of observers, each called at its own cadence:
+# e.g. the course rules on every step, but the data log for the graphs only
+# every 10 ms. Things that only matter at a specific point of the course
+# (e.g. passing a cone) can be Events with a non-terminal callback instead.
+
+class Observer:
+    def __init__(self, callback, stride = 1, period = None):
+        # callback is called like the progress listener, i.e. with
+        # (positions, velocities, t), or with a StepRecord if step_records is
+        # True, and returns True when the simulation is finished.
+        # stride: call it on every stride-th step.
+        # period: instead, call it on the first step at or after every period
+        #   seconds of simulated time.
+        self.callback = callback
+        self.stride = stride
+        self.period = period
+
+def makeObserversListener(progress_listener_callback, observers, make_step_record_p_v_t = None):
+    # Returns a listener_p_v_t(positions, velocities, t, final = False) that
+    # calls the progress listener (if any) and then the observers that are due.
+    # If any of them finishes the simulation, or final is True, all of the
+    # observers are called, so that they all see the last state.
+    num_calls = 0
+    next_times = [-math.inf] * len(observers)
+    called = [False] * len(observers)
+
+    def listener_p_v_t(positions, velocities, t, final = False):
+        nonlocal num_calls
+        num_calls += 1
+        arguments = (make_step_record_p_v_t(positions, velocities, t),) if make_step_record_p_v_t else (positions, velocities, t)
+        finished = progress_listener_callback(*arguments) if progress_listener_callback else False
+        for i in range(len(observers)):
+            observer = observers[i]
+            if observer.period:
+                # The small tolerance keeps the accumulated rounding errors in
+                # time from skipping a data point.
+                due = t >= next_times[i] - 1e-9 * observer.period
+                if due:
+                    next_time = next_times[i] + observer.period
+                    next_times[i] = next_time if next_time > t else t + observer.period
+            else:
+                due = (num_calls - 1) % observer.stride == 0
+            called[i] = due or final or finished
+            if called[i] and observer.callback(*arguments) and not finished:
+                finished = True
+                # Let the observers that were skipped see the last state too.
+                for j in range(i):
+                    if not called[j]:
+                        observers[j].callback(*arguments)
+        return finished
+
+    return listener_p_v_t
+
+# Snapshots
+#
+# Sweeping a driver parameter that only matters late in the lap (e.g. a brake
+# point) doesn't have to re-simulate the identical start of the lap for every
+# value. Capture a Snapshot in the progress listener or in an event callback,
+# stop there, and then start as many continuations from it as needed:
+#
+#   positions, velocities, t, listener_state = snapshot.fork()
+#   solveRK4(positions, velocities, other_driver_p_v_t, duration, time_step,
+#            listener, initial_time = t)
+#
+# listener_state is whatever the listener needs to carry on (the distance
+# traveled so far, the data log, ...). Each fork gets its own deep copy of it,
+# so continuations don't interfere with each other or with the snapshot.
+
+class Snapshot:
+    def __init__(self, positions, velocities, t, listener_state = None):
+        self.positions = positions[:]
+        self.velocities = velocities[:]
+        self.t = t
+        self.listener_state = copy.deepcopy(listener_state)
+
+    def fork(self):
+        return self.positions[:], self.velocities[:], self.t, copy.deepcopy(self.listener_state)
+
 # Loop functions
 
-def solveGeneric(initial_positions, initial_velocities, calculate_accelerations_p_v_t, duration, time_step, solver_function, progress_listener_callback_p_v_t):
+def solveGeneric(initial_positions, initial_velocities, calculate_accelerations_p_v_t, duration, time_step, solver_function, progress_listener_callback_p_v_t, events = None, in_place = False,
+                 segment_function_p_v_t = None, control_function_p_v_t = None, control_period = None, step_records = False, accelerations_aux = False,
+                 initial_time = 0, profile = None, observers = None):
+    # The simulation starts at initial_time (e.g. the time of a Snapshot) and
+    # ends at duration, counted from zero.
+    #
+    # With a negative time_step, the simulation runs backwards in time, from
+    # initial_time down to duration. This is how you get from a state you want
+    # to end up in (e.g. the speed at the finish) to the states that lead to
+    # it, see calculateBrakingEnvelope.
+    #
+    # If in_place is True, solver_function updates the positions and velocities
+    # lists in place instead of returning new ones (see makeNextStateRK4InPlace).
+    # The listener then gets the same two lists on every call, so it must copy
+    # them if it wants to keep the values around.
+    #
+    # segment_function_p_v_t(positions, velocities, t) may return a closed-form
+    # segment (see above) to jump to the end of instead of taking the next step,
+    # or None to take the step as usual. The listener is only called at the
+    # ends of such segments.
+    #
+    # If control_function_p_v_t is set, the simulation is multi-rate, like a
+    # real car's ECU: the control function (e.g. the driver) is only sampled at
+    # the start of every control_period (or of every step, if that's None), and
+    # its output u is held in between. calculate_accelerations_p_v_t is then
+    # called as calculate_accelerations_p_v_t(positions, velocities, t, u).
+    #
+    # If step_records is True, the listener is called with a StepRecord
+    # instead, see makeStepRecorder for accelerations_aux.
+    #
+    # observers: a list of Observers to call in addition to the progress
+    # listener, each at its own cadence (the listener is called on every step).
+    #
+    # profile: an optional SolverProfile to record the time spent in the
+    # callbacks and the step function to.
     if len(initial_positions) == 0:
         raise Exception("No positions")
     if len(initial_positions) != len(initial_velocities):
         raise Exception("The size of the positions and velocities vectors don't match (" + len(initial_positions) + " vs " + len(initial_velocities) + ")")
+    if time_step < 0 and (segment_function_p_v_t or control_function_p_v_t):
+        raise Exception("Segments and control sampling only work forward in time")
     positions = initial_positions[:]
     velocities = initial_velocities[:]
 
-    time = 0
+    if profile:
+        start_time = perf_counter()
+        num_steps_before = profile.calls.get("step", 0)
+        calculate_accelerations_p_v_t = profile.wrap("accelerations", calculate_accelerations_p_v_t)
+        solver_function = profile.wrap("step", solver_function)
+        if progress_listener_callback_p_v_t:
+            progress_listener_callback_p_v_t = profile.wrap("listener", progress_listener_callback_p_v_t)
+        if observers:
+            observers = [Observer(profile.wrap(observer.callback.__name__, observer.callback), observer.stride, observer.period) for observer in observers]
+        if control_function_p_v_t:
+            control_function_p_v_t = profile.wrap("control", control_function_p_v_t)
+        if segment_function_p_v_t:
+            segment_function_p_v_t = profile.wrap("segments", segment_function_p_v_t)
+
+    time = initial_time
+    finished = False
+    if events:
+        event_values = evaluateEvents(events, positions, velocities, time)
+    if control_function_p_v_t:
+        held_control = None
+        next_control_time = initial_time
+        controlled_accelerations_p_v_t = calculate_accelerations_p_v_t
+        calculate_accelerations_p_v_t = lambda p, v, t: controlled_accelerations_p_v_t(p, v, t, held_control)
+    listener_p_v_t = progress_listener_callback_p_v_t
+    make_step_record_p_v_t = None
+    if step_records:
+        calculate_accelerations_p_v_t, make_step_record_p_v_t = makeStepRecorder(calculate_accelerations_p_v_t, accelerations_aux)
+    if observers:
+        listener_p_v_t = makeObserversListener(progress_listener_callback_p_v_t, observers, make_step_record_p_v_t)
+    elif make_step_record_p_v_t and progress_listener_callback_p_v_t:
+        listener_p_v_t = lambda p, v, t: progress_listener_callback_p_v_t(make_step_record_p_v_t(p, v, t))
+    while time < duration if time_step > 0 else time > duration:
+        # The control is sampled before calling the listener, so that the step
+        # records see the same control as the step itself. The small tolerance
+        # keeps the accumulated rounding errors in time from skipping a sample.
+        if control_function_p_v_t and time >= next_control_time - 1e-9 * time_step:
+            held_control = control_function_p_v_t(positions, velocities, time)
+            next_control_time += control_period if control_period else time_step
+        if listener_p_v_t:
+            finished = listener_p_v_t(positions, velocities, time)
+            if finished:
+                break
+        segment = segment_function_p_v_t(positions, velocities, time) if segment_function_p_v_t else None
+        if segment:
+            segment_time = segment.timeToEnd(positions, velocities, time)
+            if segment_time <= 0:
+                # Nothing to jump over, e.g. the driver declared a segment that
+                # has already ended. Take a regular step to avoid getting stuck.
+                segment = None
+        if segment:
+            if segment_time >= duration - time:
+                segment_time = duration - time
+                next_positions, next_velocities = segment.propagate(positions, velocities, time, segment_time)
+            else:
+                next_positions, next_velocities = segment.snapToEnd(*segment.propagate(positions, velocities, time, segment_time))
+            next_time = time + segment_time
+            interpolate_state_t = lambda t: segment.propagate(positions, velocities, time, t - time)
+        else:
+            if in_place and events:
+                # Keep the state before the step around for locating the events.
+                next_positions, next_velocities = solver_function(positions[:], velocities[:], time, calculate_accelerations_p_v_t, time_step)
+            else:
+                next_positions, next_velocities = solver_function(positions, velocities, time, calculate_accelerations_p_v_t, time_step)
+            next_time = time + time_step
+            interpolate_state_t = None
+        if events:
+            next_event_values = evaluateEvents(events, next_positions, next_velocities, next_time)
+            terminal_state = handleEvents(events, event_values, next_event_values, positions, velocities, time, next_positions, next_velocities, next_time, interpolate_state_t)
+            if terminal_state:
+                positions, velocities, time = terminal_state
+                break
+            event_values = next_event_values
+        positions, velocities, time = next_positions, next_velocities, next_time
+
+    if not finished and listener_p_v_t:
+        if observers:
+            # Every observer gets to see the final state, whatever its cadence.
+            listener_p_v_t(positions, velocities, time, True)
+        else:
+            listener_p_v_t(positions, velocities, time)
+    if profile:
+        profile.wall_time += perf_counter() - start_time
+        profile.num_steps += profile.calls["step"] - num_steps_before
+    return positions, velocities, time
+
+def solveRK4(initial_positions, initial_velocities, calculate_accelerations_p_v_t, duration, time_step, progress_listener_callback_p_v_t = None, events = None,
+             segment_function_p_v_t = None, control_function_p_v_t = None, control_period = None, step_records = False, accelerations_aux = False, initial_time = 0, profile = None,
+             observers = None):
+    solver_function = getUnrolledNextStateFunction("rk4", len(initial_positions))
+    return solveGeneric(initial_positions, initial_velocities, calculate_accelerations_p_v_t, duration, time_step, solver_function, progress_listener_callback_p_v_t, events,
+                        segment_function_p_v_t = segment_function_p_v_t, control_function_p_v_t = control_function_p_v_t, control_period = control_period,
+                        step_records = step_records, accelerations_aux = accelerations_aux, initial_time = initial_time, profile = profile,
+                        observers = observers)
+
+def solveRK45(initial_positions, initial_velocities, calculate_accelerations_p_v_t, duration, time_step, progress_listener_callback_p_v_t = None,
+              relative_tolerance = 1e-6, absolute_tolerance = 1e-6, min_time_step = 1e-6, max_time_step = None, events = None, initial_time = 0):
+    # Adaptive-step version of solveRK4. time_step is only the initial guess:
+    # steps that don't meet the tolerances are rejected and retried with a
+    # smaller step, and steps that do are followed by a larger one, within
+    # [min_time_step, max_time_step]. The progress listener is called for
+    # accepted steps only.
+    if len(initial_positions) == 0:
+        raise Exception("No positions")
+    if len(initial_positions) != len(initial_velocities):
+        raise Exception(f"The size of the positions and velocities vectors don't match ({len(initial_positions)} vs {len(initial_velocities)})")
+    positions = initial_positions[:]
+    velocities = initial_velocities[:]
+
+    time = initial_time
+    k1 = None
     finished = False
+    if events:
+        event_values = evaluateEvents(events, positions, velocities, time)
     while time < duration:
         if progress_listener_callback_p_v_t:
             finished = progress_listener_callback_p_v_t(positions, velocities, time)
             if finished:
                 break
-        positions, velocities = solver_function(positions, velocities, time, calculate_accelerations_p_v_t, time_step)
-        time = time + time_step
+
+        while True:
+            # Don't step past the end of the simulation.
+            delta_t = min(time_step, duration - time)
+            next_positions, next_velocities, error, next_k1 = calculateNextStateRK45(positions, velocities, time, calculate_accelerations_p_v_t, delta_t, k1)
+            error_norm = calculateErrorNormRK45(positions + velocities, next_positions + next_velocities, error, relative_tolerance, absolute_tolerance)
+            if error_norm <= 1 or delta_t <= min_time_step:
+                break
+            time_step = max(min_time_step, delta_t * max(0.2, 0.9 * math.pow(error_norm, -0.2)))
+
+        if events:
+            next_event_values = evaluateEvents(events, next_positions, next_velocities, time + delta_t)
+            terminal_state = handleEvents(events, event_values, next_event_values, positions, velocities, time, next_positions, next_velocities, time + delta_t)
+            if terminal_state:
+                positions, velocities, time = terminal_state
+                break
+            event_values = next_event_values
+
+        positions, velocities = next_positions, next_velocities
+        time = time + delta_t
+        k1 = next_k1
+
+        if error_norm > 0:
+            time_step = delta_t * min(5, 0.9 * math.pow(error_norm, -0.2))
+        else:
+            time_step = delta_t * 5
+        time_step = max(time_step, min_time_step)
+        if max_time_step:
+            time_step = min(time_step, max_time_step)
 
     if not finished and progress_listener_callback_p_v_t:
         progress_listener_callback_p_v_t(positions, velocities, time)
     return positions, velocities, time
 
-def solveRK4(initial_positions, initial_velocities, calculate_accelerations_p_v_t, duration, time_step, progress_listener_callback_p_v_t = None):
-    return solveGeneric(initial_positions, initial_velocities, calculate_accelerations_p_v_t, duration, time_step, calculateNextStateRK4, progress_listener_callback_p_v_t)
+def calculateErrorNormRK45(y0, y1, error, relative_tolerance, absolute_tolerance):
+    # Root mean square of the error relative to the tolerances, so <= 1 means
+    # the step is accurate enough.
+    total = 0
+    for i in range(len(error)):
+        scale = absolute_tolerance + relative_tolerance * max(abs(y0[i]), abs(y1[i]))
+        total += math.pow(error[i] / scale, 2)
+    return math.sqrt(total / len(error))
+
+# Braking envelopes
+#
+# The latest possible braking point for a speed limit ahead (e.g. the speed at
+# the finish of race 2, or the speed a corner can be taken at) doesn't need to
+# be found by trial and error. Running the simulation backwards in time from
+# the limit with full braking gives the braking curve v(x): the fastest the car
+# can go at x and still make the limit. Accelerating at full throttle until
+# reaching the curve and then following it is the optimal 1D profile.
+
+def calculateBrakingEnvelope(end_position, end_velocity, calculate_accelerations_p_v_t, time_step, min_position = None, max_velocity = None, max_duration = 1000):
+    # calculate_accelerations_p_v_t is the (1D) car at full braking. Returns
+    # the curve as a list of (x, v), sorted by x. It starts where the car is
+    # max_duration seconds before reaching end_position, or at min_position or
+    # max_velocity if it gets there first.
+    table = []
+    def progress_listener_callback_p_v_t(positions, velocities, t):
+        table.append((positions[0], velocities[0]))
+        if min_position is not None and positions[0] <= min_position:
+            return True
+        return max_velocity is not None and velocities[0] >= max_velocity
+    solveRK4([end_position], [end_velocity], calculate_accelerations_p_v_t, -max_duration, -abs(time_step), progress_listener_callback_p_v_t)
+    table.reverse()
+    return table
+
+def interpolateBrakingEnvelope(table, x):
+    # The speed limit at x, linearly interpolated between the points of a
+    # table from calculateBrakingEnvelope. None past the ends of the table.
+    if not table or x < table[0][0] or x > table[-1][0]:
+        return None
+    i = bisect.bisect_left(table, (x,))
+    if table[i][0] == x or i == 0:
+        return table[i][1]
+    (x0, v0), (x1, v1) = table[i - 1], table[i]
+    return v0 + (v1 - v0) * (x - x0) / (x1 - x0)
+
+# Parallel-in-time loop functions
+#
+# A single simulation is inherently serial, but the parareal algorithm can
+# still spread it over several cores. The time is split into slices, and:
+#   1. A cheap coarse propagator (RK4 with a large time step) runs serially
+#      through all the slices to guess the state at the start of each one.
+#   2. The fine propagator (RK4 with the real time step) runs all the slices
+#      in parallel, each from its guessed start state.
+#   3. The guesses are corrected with the difference between the fine and the
+#      coarse results, and this repeats until the guesses stop changing.
+# After k iterations, the first k slices are exact, so in the worst case this
+# is as slow as a serial run. Smooth problems usually converge in a few
+# iterations, though.
+
+def propagateRK4Steps(positions, velocities, t, calculate_accelerations_p_v_t, time_step, num_steps, finished_callback_p_v_t = None):
+    # Takes exactly num_steps steps, so the slices line up no matter how the
+    # rounding errors in time accumulate. Returns (positions, velocities, t,
+    # finished).
+    solver_function = getUnrolledNextStateFunction("rk4", len(positions))
+    start_time = t
+    for i in range(num_steps):
+        if finished_callback_p_v_t and finished_callback_p_v_t(positions, velocities, t):
+            return positions, velocities, t, True
+        positions, velocities = solver_function(positions, velocities, t, calculate_accelerations_p_v_t, time_step)
+        t = start_time + (i + 1) * time_step
+    return positions, velocities, t, False
+
+def propagatePararealSlice(arguments):
+    # A top-level function that takes a single tuple, so that it can be sent
+    # to a process pool.
+    return propagateRK4Steps(*arguments)
+
+def solveParareal(initial_positions, initial_velocities, calculate_accelerations_p_v_t, duration, time_step, coarse_time_step,
+                  finished_callback_p_v_t = None, num_slices = None, tolerance = 1e-9, max_iterations = None, map_function = None):
+    # Same as solveRK4 with finished_callback_p_v_t as the progress listener,
+    # up to the tolerance. The fine slices run in a process pool, so
+    # calculate_accelerations_p_v_t and finished_callback_p_v_t must be
+    # picklable, i.e. defined at the top level of a module. The callback is
+    # only told whether the simulation has finished, and may be called more
+    # than once for the same state, so it shouldn't record anything.
+    #
+    # The iterations stop when no slice start state changes by more than
+    # tolerance. map_function(function, arguments) replaces the process pool,
+    # e.g. the built-in map to run everything in this process.
+    if len(initial_positions) == 0:
+        raise Exception("No positions")
+    if len(initial_positions) != len(initial_velocities):
+        raise Exception(f"The size of the positions and velocities vectors don't match ({len(initial_positions)} vs {len(initial_velocities)})")
+    if not num_slices:
+        num_slices = os.cpu_count() or 1
+    if not max_iterations:
+        max_iterations = num_slices
+    if map_function is None:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(num_slices) as executor:
+            return solveParareal(initial_positions, initial_velocities, calculate_accelerations_p_v_t, duration, time_step, coarse_time_step,
+                                 finished_callback_p_v_t, num_slices, tolerance, max_iterations, executor.map)
+
+    # Same number of steps as solveGeneric would take. Every slice has a whole
+    # number of fine and coarse steps.
+    num_steps = math.ceil(duration / time_step - 1e-9)
+    num_slices = min(num_slices, num_steps)
+    slice_steps = [num_steps // num_slices + (1 if n < num_steps % num_slices else 0) for n in range(num_slices)]
+    slice_start_times = [sum(slice_steps[:n]) * time_step for n in range(num_slices)]
+    coarse_slice_steps = [max(1, round(steps * time_step / coarse_time_step)) for steps in slice_steps]
+
+    def coarse(n, positions, velocities):
+        coarse_time_step_n = slice_steps[n] * time_step / coarse_slice_steps[n]
+        return propagateRK4Steps(positions, velocities, slice_start_times[n], calculate_accelerations_p_v_t, coarse_time_step_n, coarse_slice_steps[n])[:2]
+
+    starts = [(initial_positions[:], initial_velocities[:])]
+    coarse_results = []
+    for n in range(num_slices):
+        coarse_results.append(coarse(n, *starts[n]))
+        starts.append(coarse_results[n])
+
+    fine_results = [None] * num_slices
+    for iteration in range(max_iterations):
+        # The first `iteration` slices have exact start states already, so
+        # their fine results from the previous iterations are final.
+        arguments = [(starts[n][0], starts[n][1], slice_start_times[n], calculate_accelerations_p_v_t, time_step, slice_steps[n], finished_callback_p_v_t)
+                     for n in range(iteration, num_slices)]
+        fine_results[iteration:] = map_function(propagatePararealSlice, arguments)
+
+        # Slices up to and including this one are exact, so a finish in them
+        # is final.
+        for n in range(iteration + 1):
+            if fine_results[n][3]:
+                return fine_results[n][:3]
+
+        change = 0
+        for n in range(iteration, num_slices):
+            next_coarse_result = coarse(n, *starts[n])
+            next_start = ([g + f - old_g for g, f, old_g in zip(next_coarse_result[0], fine_results[n][0], coarse_results[n][0])],
+                          [g + f - old_g for g, f, old_g in zip(next_coarse_result[1], fine_results[n][1], coarse_results[n][1])])
+            if n == iteration:
+                # The start of this slice was exact, and so is its end.
+                next_start = fine_results[n][:2]
+            for old, new in zip(starts[n + 1][0] + starts[n + 1][1], next_start[0] + next_start[1]):
+                change = max(change, abs(new - old))
+            coarse_results[n] = next_coarse_result
+            starts[n + 1] = next_start
+        if change <= tolerance:
+            break
+
+    # The start states have converged, so the fine results agree with them.
+    for n in range(num_slices):
+        if fine_results[n][3]:
+            return fine_results[n][:3]
+    positions, velocities = starts[num_slices]
+    return positions, velocities, slice_start_times[-1] + slice_steps[-1] * time_step
+
+# Batched loop functions
+#
+# These advance N independent trajectories at once, which is handy for sweeps
+# over many driver variants. They require NumPy.
+
+def solveRK4Batch(initial_positions, initial_velocities, calculate_accelerations_p_v_t, duration, time_step, finished_callback_p_v_t = None):
+    # initial_positions and initial_velocities are (N, D) arrays, one row per
+    # trajectory.
+    #
+    # calculate_accelerations_p_v_t(positions, velocities, t) receives the full
+    # (N, D) arrays and must return an (N, D) array of accelerations.
+    #
+    # finished_callback_p_v_t(positions, velocities, t) returns an (N,) array of
+    # booleans; once a trajectory reports True it stops being advanced and its
+    # finish time is recorded.
+    #
+    # Returns the final (N, D) positions and velocities, and an (N,) array of
+    # times: the finish time for the finished trajectories, and the end of the
+    # simulation for the rest -- the same way solveGeneric reports the time.
+    import numpy as np
+
+    positions = np.array(initial_positions, dtype=float)
+    velocities = np.array(initial_velocities, dtype=float)
+    if positions.ndim != 2 or positions.shape[1] == 0:
+        raise Exception("Positions must be an (N, D) array with D > 0")
+    if positions.shape != velocities.shape:
+        raise Exception(f"The shapes of the positions and velocities arrays don't match ({positions.shape} vs {velocities.shape})")
+
+    num_trajectories = positions.shape[0]
+    times = np.full(num_trajectories, np.nan)
+    active = np.ones(num_trajectories, dtype=bool)
+
+    time = 0
+    while time < duration:
+        if finished_callback_p_v_t:
+            just_finished = active & np.asarray(finished_callback_p_v_t(positions, velocities, time), dtype=bool)
+            times[just_finished] = time
+            active &= ~just_finished
+            if not active.any():
+                break
+        next_positions, next_velocities = calculateNextStateRK4Batch(positions, velocities, time, calculate_accelerations_p_v_t, time_step)
+        positions[active] = next_positions[active]
+        velocities[active] = next_velocities[active]
+        time = time + time_step
+
+    times[active] = time
+    return positions, velocities, times
 
 #### Self tests
 
@@ -295,6 +1348,451 @@ class TestStringMethods(unittest.TestCase):
         self.assertEqualsApprox(time, 4.2, 0.001)
         self.assertEqualsApprox(positions[0], 4.2, 0.001)
 
+    def test_rk45_pendulum(self):
+        # Same system as test_pendulum, but with adaptive steps.
+        init_positions = [1]
+        init_velocities = [0]
+        calculate_accelerations_p_v_t = lambda p, v, t: [-p[0]]
+        energy = lambda p, v: 0.5 * (math.pow(p[0], 2) + math.pow(v[0], 2))
+
+        num_steps = 0
+        def progress_listener_callback_p_v_t(p, v, t):
+            nonlocal num_steps
+            num_steps += 1
+            return False
+
+        positions, velocities, time = solveRK45(init_positions, init_velocities, calculate_accelerations_p_v_t, 10 * math.pi, 0.001, progress_listener_callback_p_v_t,
+                                                relative_tolerance = 1e-9, absolute_tolerance = 1e-9)
+        self.assertEqualsApprox(time, 10 * math.pi, 1e-12)
+        self.assertEqualsApprox(positions[0], 1, 0.000001)
+        self.assertEqualsApprox(velocities[0], 0, 0.000001)
+        self.assertEqualsApprox(energy(positions, velocities), 0.5, 0.000001)
+        # A fixed 0.001 step would take over 31k steps for the same precision.
+        self.assertLess(num_steps, 2000)
+
+    def test_rk45_constant_force_step_bounds(self):
+        # With a constant force the error estimate is zero, so the steps grow
+        # until they hit max_time_step.
+        # x(t) = 1 * t^2 / 2,
+        # v_x(t) = 1 * t.
+        times = []
+        def progress_listener_callback_p_v_t(p, v, t):
+            times.append(t)
+            return False
+
+        positions, velocities, time = solveRK45([0], [0], lambda p, v, t: [1], 10, 0.001, progress_listener_callback_p_v_t, max_time_step = 0.5)
+        self.assertEqualsApprox(time, 10, 1e-12)
+        self.assertEqualsApprox(positions[0], 50, 1e-9)
+        self.assertEqualsApprox(velocities[0], 10, 1e-9)
+        for i in range(1, len(times)):
+            self.assertLessEqual(times[i] - times[i - 1], 0.5 + 1e-12)
+        self.assertLess(len(times), 30)
+
+    def test_rk45_finish(self):
+        # x(t) = 1 * t,
+        # v_x(t) = 1.
+        #
+        # Should reach x >= 10 in 10 seconds.
+        progress_listener_callback_p_v_t = lambda p, v, t: p[0] >= 10
+
+        positions, velocities, time = solveRK45([0], [1], lambda p, v, t: [0], 100, 0.001, progress_listener_callback_p_v_t, max_time_step = 0.001)
+
+        self.assertEqualsApprox(time, 10, 0.001)
+        self.assertEqualsApprox(positions[0], 10, 0.001)
+
+    def test_event_finish(self):
+        # x(t) = 1 * t^2 / 2,
+        # v_x(t) = 1 * t.
+        #
+        # Should reach x = 50 at exactly 10 seconds, even with a coarse time step.
+        finish = Event(lambda p, v, t: p[0] - 50, direction = 1)
+
+        positions, velocities, time = solveRK4([0], [0], lambda p, v, t: [1], 100, 0.3, None, [finish])
+
+        self.assertEqualsApprox(time, 10, 1e-9)
+        self.assertEqualsApprox(positions[0], 50, 1e-9)
+        self.assertEqualsApprox(velocities[0], 10, 1e-9)
+
+    def test_event_condition_and_callback(self):
+        # A circular motion:
+        #   x = cos(t),
+        #   y = sin(t).
+        # Record every crossing of y = 0 while x < 0 (t = pi, 3 * pi, ...) and
+        # stop at the first crossing of x = 0 going right after t = 20.
+        crossings = []
+        cone = Event(lambda p, v, t: p[1],
+                     terminal = False,
+                     condition_p_v_t = lambda p, v, t: p[0] < 0,
+                     callback_p_v_t = lambda p, v, t: crossings.append(t))
+        finish = Event(lambda p, v, t: p[0],
+                       direction = 1,
+                       condition_p_v_t = lambda p, v, t: t > 20)
+
+        positions, velocities, time = solveRK4([1, 0], [0, 1], lambda p, v, t: [-p[0], -p[1]], 100, 0.05, None, [cone, finish])
+
+        self.assertEqual(len(crossings), 4)
+        for i in range(4):
+            self.assertEqualsApprox(crossings[i], (2 * i + 1) * math.pi, 0.00001)
+        self.assertEqualsApprox(time, 7.5 * math.pi, 0.00001)
+        self.assertEqualsApprox(positions[0], 0, 0.00001)
+        # The radius drifts a bit over ~470 steps of that size.
+        self.assertEqualsApprox(positions[1], -1, 0.0002)
+
+    def test_rk45_event_finish(self):
+        # x(t) = 1 * t^2 / 2, should reach x = 50 at exactly 10 seconds while
+        # the steps grow much larger than that precision.
+        finish = Event(lambda p, v, t: p[0] - 50, direction = 1)
+
+        positions, velocities, time = solveRK45([0], [0], lambda p, v, t: [1], 100, 0.001, None, max_time_step = 1, events = [finish])
+
+        self.assertEqualsApprox(time, 10, 1e-9)
+        self.assertEqualsApprox(positions[0], 50, 1e-9)
+
+    def test_in_place_matches_rk4(self):
+        # The in-place kernel must give exactly the same results as
+        # calculateNextStateRK4, including the event handling.
+        init_positions = [1, 1]
+        init_velocities = [0, 0]
+        calculate_accelerations_p_v_t = lambda p, v, t: [-p[0], -4*p[1]]
+        make_finish = lambda: Event(lambda p, v, t: p[0] + 0.5, direction = -1)
+
+        expected = solveGeneric(init_positions, init_velocities, calculate_accelerations_p_v_t, 10, 0.001, calculateNextStateRK4, None, [make_finish()])
+        actual = solveGeneric(init_positions, init_velocities, calculate_accelerations_p_v_t, 10, 0.001, makeNextStateRK4InPlace(2), None, [make_finish()], in_place = True)
+
+        self.assertEqual(actual, expected)
+        self.assertEqualsApprox(actual[2], 2 * math.pi / 3, 0.00001)
+        # The caller's lists are left alone.
+        self.assertEqual(init_positions, [1, 1])
+        self.assertEqual(init_velocities, [0, 0])
+
+    def test_unrolled_matches_generic(self):
+        # The generated step functions must give exactly the same results as
+        # the generic ones, for any dimension.
+        calculate_accelerations_p_v_t = lambda p, v, t: [-(i + 1) * p[i] - 0.1 * v[i] + t for i in range(len(p))]
+        for dimension in range(1, 4):
+            init_positions = [1 + i for i in range(dimension)]
+            init_velocities = [0.5 * i for i in range(dimension)]
+            for method, generic_function in [("euler", calculateNextStateEuler), ("rk4", calculateNextStateRK4)]:
+                expected = solveGeneric(init_positions, init_velocities, calculate_accelerations_p_v_t, 2, 0.01, generic_function, None)
+                actual = solveGeneric(init_positions, init_velocities, calculate_accelerations_p_v_t, 2, 0.01, getUnrolledNextStateFunction(method, dimension), None)
+                self.assertEqual(actual, expected)
+        self.assertIs(getUnrolledNextStateFunction("rk4", 2), getUnrolledNextStateFunction("rk4", 2))
+
+    def test_symplectic_pendulum(self):
+        # Same system as test_pendulum_2D. With symplectic integrators the
+        # energy error stays bounded instead of drifting, even over 50 periods.
+        init_positions = [1, 1]
+        init_velocities = [0, 0]
+        num_calls = 0
+        def calculate_accelerations_p_v_t(p, v, t):
+            nonlocal num_calls
+            num_calls += 1
+            return [-p[0], -4*p[1]]
+        energy = lambda p, v: 0.5 * (math.pow(p[0], 2) + math.pow(v[0], 2) + 4 * math.pow(p[1], 2) + math.pow(v[1], 2))
+
+        max_energy_error = 0
+        def progress_listener_callback_p_v_t(p, v, t):
+            nonlocal max_energy_error
+            max_energy_error = max(max_energy_error, abs(energy(p, v) - 2.5))
+            return False
+
+        positions, velocities, time = solveGeneric(init_positions, init_velocities, calculate_accelerations_p_v_t, 314.1593, 0.001, makeNextStateVelocityVerlet(), progress_listener_callback_p_v_t)
+        self.assertEqualsApprox(positions[0], 1, 0.0001)
+        self.assertEqualsApprox(positions[1], 1, 0.0003)
+        self.assertLess(max_energy_error, 0.000003)
+        # One acceleration evaluation per step, plus one for the first step.
+        self.assertEqual(num_calls, 314160 + 1)
+
+        num_calls = 0
+        max_energy_error = 0
+        positions, velocities, time = solveGeneric(init_positions, init_velocities, calculate_accelerations_p_v_t, 314.1593, 0.01, calculateNextStateYoshida4, progress_listener_callback_p_v_t)
+        self.assertEqualsApprox(positions[0], 1, 0.0001)
+        self.assertEqualsApprox(positions[1], 1, 0.0003)
+        self.assertLess(max_energy_error, 0.000001)
+        self.assertEqual(num_calls, 3 * 31416)
+
+    def test_segments(self):
+        # Accelerate at 10 m/s^2 until x = 20 (t = 2, v = 20), then continue at
+        # a constant 200 W/kg until v = 40 (t = 5, x = 20 + (40^3 - 20^3) / 600),
+        # then brake at 10 m/s^2 until stopped (t = 9, 80 more meters).
+        def segment_function_p_v_t(p, v, t):
+            if p[0] < 20:
+                return ConstantAccelerationSegment([10], end_position = 20)
+            if v[0] < 40 and t < 5:
+                return PowerLimitedSegment(200, end_velocity = 40)
+            if v[0] > 0:
+                return ConstantAccelerationSegment([-10], end_velocity = 0)
+            return None
+
+        calculate_accelerations_p_v_t = lambda p, v, t: [10 if p[0] < 20 else (200 / v[0] if v[0] < 40 and t < 5 else (-10 if v[0] > 0 else 0))]
+        expected_distance = 20 + (40**3 - 20**3) / 600 + 80
+
+        states = []
+        def progress_listener_callback_p_v_t(p, v, t):
+            states.append((p[0], v[0], t))
+            return t > 5 and v[0] <= 0
+        positions, velocities, time = solveRK4([0], [0], calculate_accelerations_p_v_t, 100, 0.0001, progress_listener_callback_p_v_t,
+                                               segment_function_p_v_t = segment_function_p_v_t)
+
+        self.assertEqual(len(states), 4)
+        self.assertEqual(states[1], (20, 20, 2))
+        self.assertEqual(states[2][1], 40)
+        self.assertEqualsApprox(states[2][2], 5, 1e-12)
+        self.assertEqual(velocities[0], 0)
+        self.assertEqualsApprox(positions[0], expected_distance, 1e-12)
+        self.assertEqualsApprox(time, 9, 1e-12)
+
+        # Step by step integration agrees.
+        positions, velocities, time = solveRK4([0], [0], calculate_accelerations_p_v_t, 100, 0.0001, lambda p, v, t: t > 5 and v[0] <= 0)
+        self.assertEqualsApprox(positions[0], expected_distance, 0.01)
+        self.assertEqualsApprox(time, 9, 0.001)
+
+    def test_segment_events(self):
+        # Events inside a segment are located on the exact solution.
+        # x(t) = (200 * t)^(3/2) / 300 for a constant 100 W/kg from a standstill.
+        finish = Event(lambda p, v, t: p[0] - 50, direction = 1)
+        positions, velocities, time = solveRK4([0], [0], lambda p, v, t: [0], 100, 0.1, None, [finish],
+                                               segment_function_p_v_t = lambda p, v, t: PowerLimitedSegment(100))
+        self.assertEqualsApprox(time, math.pow(300 * 50, 2 / 3) / 200, 1e-9)
+        self.assertEqualsApprox(positions[0], 50, 1e-9)
+
+    def test_control_rate(self):
+        # The "driver" asks for an acceleration equal to the current time, but
+        # is only sampled 10 times per second. With a zero-order hold, the
+        # velocity at t = 1 is sum(0.1 * 0.1 * k for k in range(10)) = 0.45
+        # instead of the continuous 0.5.
+        num_control_calls = 0
+        def control_function_p_v_t(p, v, t):
+            nonlocal num_control_calls
+            num_control_calls += 1
+            return t
+
+        positions, velocities, time = solveRK4([0], [0], lambda p, v, t, u: [u], 1, 0.001,
+                                               control_function_p_v_t = control_function_p_v_t, control_period = 0.1)
+        self.assertEqual(num_control_calls, 10)
+        self.assertEqualsApprox(velocities[0], 0.45, 0.000001)
+
+        # Without a control period, the control function is sampled once per step.
+        num_control_calls = 0
+        positions, velocities, time = solveRK4([0], [0], lambda p, v, t, u: [u], 1, 0.001,
+                                               control_function_p_v_t = control_function_p_v_t)
+        self.assertEqual(num_control_calls, 1000)
+        self.assertEqualsApprox(velocities[0], 0.5, 0.001)
+
+    def test_step_records(self):
+        num_calls = 0
+        def calculate_accelerations_p_v_t(p, v, t):
+            nonlocal num_calls
+            num_calls += 1
+            return [-p[0]], p[0] * 2
+
+        records = []
+        positions, velocities, time = solveRK4([1], [0], calculate_accelerations_p_v_t, 1, 0.01, records.append,
+                                               step_records = True, accelerations_aux = True)
+        # One call per RK4 stage, plus one for the record after the last step.
+        self.assertEqual(num_calls, 4 * 100 + 1)
+        self.assertEqual(len(records), 101)
+        for record in records:
+            self.assertEqual(record.accelerations, [-record.positions[0]])
+            self.assertEqual(record.aux, record.positions[0] * 2)
+        self.assertEqual(records[-1].t, time)
+
+        expected_positions, expected_velocities, expected_time = solveRK4([1], [0], lambda p, v, t: [-p[0]], 1, 0.01)
+        self.assertEqual(positions, expected_positions)
+        self.assertEqual(velocities, expected_velocities)
+
+    def test_step_records_in_place(self):
+        # The in-place kernel passes the same stage lists to k2 and k3 at the
+        # same time, which must not be mistaken for the state of the record.
+        num_calls = 0
+        def calculate_accelerations_p_v_t(p, v, t):
+            nonlocal num_calls
+            num_calls += 1
+            return [-p[0]]
+
+        expected = solveGeneric([1], [0], calculate_accelerations_p_v_t, 1, 0.01, calculateNextStateRK4, None)
+        num_calls = 0
+        records = []
+        actual = solveGeneric([1], [0], calculate_accelerations_p_v_t, 1, 0.01, makeNextStateRK4InPlace(1), records.append,
+                              in_place = True, step_records = True)
+        self.assertEqual(actual, expected)
+        self.assertEqual(num_calls, 4 * 100 + 1)
+        self.assertEqual(len(records), 101)
+
+    def test_snapshot_fork(self):
+        # Accelerate, then brake from brake_time on. Runs with different brake
+        # times share the prefix up to t = 2.
+        def make_driver_p_v_t(brake_time):
+            return lambda p, v, t: [-10] if t >= brake_time else [5]
+
+        snapshot = None
+        def progress_listener_callback_p_v_t(p, v, t):
+            nonlocal snapshot
+            if t >= 2:
+                snapshot = Snapshot(p, v, t, {"log": [t]})
+                return True
+            return False
+        solveRK4([0], [0], make_driver_p_v_t(100), 10, 0.001, progress_listener_callback_p_v_t)
+        self.assertEqualsApprox(snapshot.t, 2, 0.0011)
+
+        for brake_time in [3, 4]:
+            expected_positions, expected_velocities, expected_time = solveRK4([0], [0], make_driver_p_v_t(brake_time), 6, 0.001)
+            positions, velocities, t, listener_state = snapshot.fork()
+            listener_state["log"].append(brake_time)
+            positions, velocities, time = solveRK4(positions, velocities, make_driver_p_v_t(brake_time), 6, 0.001, initial_time = t)
+            self.assertEqual(positions, expected_positions)
+            self.assertEqual(velocities, expected_velocities)
+            self.assertEqual(time, expected_time)
+        # The forks didn't change the snapshot.
+        self.assertEqual(snapshot.listener_state["log"], [snapshot.t])
+
+    def test_parareal_matches_serial(self):
+        def calculate_accelerations_p_v_t(p, v, t):
+            return [-p[0], -p[1] - 0.1 * v[1]]
+        def finished_callback_p_v_t(p, v, t):
+            return t > 5 and p[0] >= 0.5
+
+        expected_positions, expected_velocities, expected_time = solveRK4([1, 1], [0, 0], calculate_accelerations_p_v_t, 20, 0.001)
+        positions, velocities, time = solveParareal([1, 1], [0, 0], calculate_accelerations_p_v_t, 20, 0.001, 0.1,
+                                                    num_slices = 8, map_function = map)
+        self.assertEqualsApprox(time, expected_time, 0.000001)
+        for actual, expected in zip(positions + velocities, expected_positions + expected_velocities):
+            self.assertEqualsApprox(actual, expected, 0.000001)
+
+        expected_positions, expected_velocities, expected_time = solveRK4([1, 1], [0, 0], calculate_accelerations_p_v_t, 20, 0.001, finished_callback_p_v_t)
+        positions, velocities, time = solveParareal([1, 1], [0, 0], calculate_accelerations_p_v_t, 20, 0.001, 0.1, finished_callback_p_v_t,
+                                                    num_slices = 8, map_function = map)
+        self.assertEqualsApprox(time, expected_time, 0.000001)
+        self.assertEqualsApprox(positions[0], expected_positions[0], 0.000001)
+
+    def test_backwards_in_time(self):
+        # Going back in time undoes going forward. The time step is a power of
+        # two so that the time doesn't overshoot due to rounding errors.
+        calculate_accelerations_p_v_t = lambda p, v, t: [-p[0]]
+        positions, velocities, time = solveRK4([1], [0], calculate_accelerations_p_v_t, 3, 1 / 1024)
+        positions, velocities, time = solveRK4(positions, velocities, calculate_accelerations_p_v_t, 0, -1 / 1024, initial_time = time)
+        self.assertEqualsApprox(time, 0, 0.000001)
+        self.assertEqualsApprox(positions[0], 1, 0.000001)
+        self.assertEqualsApprox(velocities[0], 0, 0.000001)
+
+        # Events work backwards as well.
+        finish = Event(lambda p, v, t: p[0] - 0.5)
+        positions, velocities, time = solveRK4([1], [0], lambda p, v, t: [-1], -10, -0.3, None, [finish])
+        self.assertEqualsApprox(time, -1, 0.000001)
+
+    def test_braking_envelope(self):
+        # Race 2 with traction-limited acceleration and braking at 10 m/s^2:
+        # finish at x = 100 with 30 m/s, start at 30 m/s as well.
+        envelope = calculateBrakingEnvelope(100, 30, lambda p, v, t: [-10], 0.001, min_position = 0)
+        self.assertEqualsApprox(envelope[-1][0], 100, 0.000001)
+        self.assertLessEqual(envelope[0][0], 0)
+        for x in [0, 25, 50, 99.99]:
+            self.assertEqualsApprox(interpolateBrakingEnvelope(envelope, x), math.sqrt(900 + 20 * (100 - x)), 0.0001)
+        self.assertIsNone(interpolateBrakingEnvelope(envelope, 101))
+
+        # Full throttle until the envelope, then follow it.
+        def calculate_accelerations_p_v_t(p, v, t):
+            limit = interpolateBrakingEnvelope(envelope, p[0])
+            return [10 if limit is None or v[0] < limit else -10]
+        positions, velocities, time = solveRK4([0], [30], calculate_accelerations_p_v_t, 10, 0.0001, lambda p, v, t: p[0] >= 100)
+        self.assertEqualsApprox(velocities[0], 30, 0.01)
+        # Accelerating to sqrt(1900) m/s at x = 50 and braking back down.
+        self.assertEqualsApprox(time, 2 * (math.sqrt(1900) - 30) / 10, 0.001)
+
+    def test_profile(self):
+        profile = SolverProfile()
+        driver_p_v_t = profile.wrap("driver", lambda p, v, t: [-p[0]])
+        solveRK4([1], [0], lambda p, v, t: driver_p_v_t(p, v, t), 1, 0.01, lambda p, v, t: False, profile = profile)
+        self.assertEqual(profile.num_steps, 100)
+        self.assertEqual(profile.calls["step"], 100)
+        self.assertEqual(profile.calls["accelerations"], 400)
+        self.assertEqual(profile.calls["driver"], 400)
+        self.assertEqual(profile.calls["listener"], 101)
+        # The driver is called from the accelerations function, which is
+        # called from the step function.
+        self.assertLessEqual(profile.total_times["driver"], profile.total_times["accelerations"])
+        self.assertLessEqual(profile.total_times["accelerations"], profile.total_times["step"])
+        self.assertEqualsApprox(profile.self_times["accelerations"], profile.total_times["accelerations"] - profile.total_times["driver"], 0.000001)
+        self.assertLessEqual(sum(profile.self_times.values()), profile.wall_time)
+        self.assertIn("steps/second", profile.report())
+
+    def test_observers(self):
+        every_step, every_10th_step, every_50ms = [], [], []
+        observers = [
+            Observer(lambda p, v, t: every_10th_step.append(t), stride = 10),
+            Observer(lambda p, v, t: every_50ms.append(t), period = 0.05),
+        ]
+        def progress_listener_callback_p_v_t(p, v, t):
+            every_step.append(t)
+            return p[0] >= 0.5
+        positions, velocities, time = solveRK4([0], [0], lambda p, v, t: [1], 10, 0.001, progress_listener_callback_p_v_t, observers = observers)
+
+        # Finished at t = 1 (x = t^2 / 2).
+        self.assertEqualsApprox(time, 1, 0.0011)
+        self.assertEqual(every_step[-1], time)
+        self.assertEqual(len(every_10th_step), 101)
+        self.assertEqual(len(every_50ms), 21)
+        for i in range(1, 20):
+            self.assertEqualsApprox(every_50ms[i] - every_50ms[i - 1], 0.05, 0.0011)
+        # Everybody sees the final state.
+        self.assertEqual(every_10th_step[-1], time)
+        self.assertEqual(every_50ms[-1], time)
+
+        # When the time runs out.
+        every_10th_step = []
+        solveRK4([0], [0], lambda p, v, t: [1], 0.0055, 0.001, None, observers = observers[:1])
+        self.assertEqual(len(every_10th_step), 2)
+
+    def test_batch_matches_single_trajectories(self):
+        try:
+            import numpy as np
+        except ModuleNotFoundError:
+            self.skipTest("NumPy is not installed")
+
+        # Three 2D pendulums with different stiffness along the y axis, each
+        # finishing when it first crosses y = 0.
+        stiffness = np.array([1.0, 4.0, 9.0])
+        init_positions = [[1, 1], [1, 1], [1, 1]]
+        init_velocities = [[0, 0], [0, 0], [0, 0]]
+        calculate_accelerations_batch = lambda p, v, t: np.stack([-p[:, 0], -stiffness * p[:, 1]], axis=1)
+        finished_callback_batch = lambda p, v, t: p[:, 1] <= 0
+
+        positions, velocities, times = solveRK4Batch(init_positions, init_velocities, calculate_accelerations_batch, 10, 0.001, finished_callback_batch)
+
+        for i in range(len(stiffness)):
+            k = stiffness[i]
+            expected_positions, expected_velocities, expected_time = solveRK4(
+                init_positions[i], init_velocities[i],
+                lambda p, v, t: [-p[0], -k * p[1]],
+                10, 0.001,
+                lambda p, v, t: p[1] <= 0)
+            self.assertEqual(times[i], expected_time)
+            for d in range(2):
+                self.assertEqualsApprox(positions[i][d], expected_positions[d], 1e-12)
+                self.assertEqualsApprox(velocities[i][d], expected_velocities[d], 1e-12)
+
+        # The y = 0 crossing happens at t = pi / (2 * sqrt(k)).
+        self.assertEqualsApprox(times[0], math.pi / 2, 0.001)
+        self.assertEqualsApprox(times[2], math.pi / 6, 0.001)
+
+    def test_batch_dnf(self):
+        try:
+            import numpy as np
+        except ModuleNotFoundError:
+            self.skipTest("NumPy is not installed")
+
+        # Only the faster of the two cars reaches x >= 10 within 4.2 seconds.
+        positions, velocities, times = solveRK4Batch(
+            [[0], [0]], [[1], [5]],
+            lambda p, v, t: np.zeros_like(p),
+            4.2, 0.001,
+            lambda p, v, t: p[:, 0] >= 10)
+
+        self.assertEqualsApprox(times[0], 4.2, 0.001)
+        self.assertEqualsApprox(positions[0][0], 4.2, 0.001)
+        self.assertEqualsApprox(times[1], 2, 0.001)
+        self.assertEqualsApprox(positions[1][0], 10, 0.005)
+
 if __name__ == '__main__':
     print("Running solver tests:")
     unittest.main()
@@ -0,0 +1,367 @@
+# Telemetry of a run, stored by channel: one array of floats per channel (time,
+# distance, speed, ...) instead of a tuple per graph per data point, so a long
+# run takes 8 bytes per channel per data point.
+#
+# For example:
+#   log = TelemetryLog(["t", "distance", "speed"], every_distance = 0.5)
+#   log.append(t, distance, speed)  # every step; only some are kept.
+#   data_log = log.data_log([("speed", "distance", "speed, m/s", "distance, m")])
+#   data_log_plotter.plot_graphs(data_log, "speed.png")
+
+import array
+import hashlib
+import inspect
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import unittest
+
+class TelemetryLog:
+    # channels are the names of the values passed to append, in that order.
+    # Only every every_steps-th data point is kept, and only if the
+    # distance_channel went up by every_distance since the last one kept.
+    # With max_bytes, when the channels reach that size, every other data
+    # point is dropped and from then on only half as many are kept.
+    def __init__(self, channels, every_steps = 1, every_distance = None, distance_channel = "distance", max_bytes = None):
+        self.channels = list(channels)
+        self.columns = {name: array.array("d") for name in self.channels}
+        self.every_steps = every_steps
+        self.every_distance = every_distance
+        self.distance_index = self.channels.index(distance_channel) if every_distance is not None else None
+        self.max_samples = None if max_bytes is None else max(2, max_bytes // (8 * len(self.channels)))
+        self.steps_since_sample = every_steps
+        self.last_sample_distance = -math.inf
+
+    def __len__(self):
+        return len(self.columns[self.channels[0]])
+
+    # Returns whether the data point was kept. None values (e.g. the G forces
+    # when standing still) are stored as NaN.
+    def append(self, *values):
+        self.steps_since_sample += 1
+        if self.steps_since_sample < self.every_steps:
+            return False
+        if self.distance_index is not None:
+            if values[self.distance_index] - self.last_sample_distance < self.every_distance:
+                return False
+            self.last_sample_distance = values[self.distance_index]
+        self.steps_since_sample = 0
+
+        if self.max_samples is not None and len(self) >= self.max_samples:
+            self.downsample()
+        for name, value in zip(self.channels, values):
+            self.columns[name].append(math.nan if value is None else value)
+        return True
+
+    def downsample(self):
+        for name in self.channels:
+            self.columns[name] = self.columns[name][::2]
+        self.every_steps *= 2
+        if self.every_distance is not None:
+            self.every_distance *= 2
+
+    def column(self, name):
+        return self.columns[name]
+
+    # Adds (or replaces) a channel with a value for every data point, e.g. one
+    # from derived_channels. Nothing can be appended afterwards.
+    def add_channel(self, name, values):
+        if len(values) != len(self):
+            raise Exception(f"Expected {len(self)} values for {name}, got {len(values)}")
+        if name not in self.columns:
+            self.channels.append(name)
+        self.columns[name] = array.array("d", values)
+
+    # A NumPy array sharing the memory of the channel, without copying it.
+    # Nothing can be appended while the array is alive.
+    def numpy_column(self, name):
+        import numpy
+        return numpy.frombuffer(self.columns[name], dtype = numpy.float64)
+
+    # The telemetry in the data_log format of data_log_plotter.plot_graphs:
+    # graphs are (vertical channel, horizontal channel, vertical axis label,
+    # horizontal axis label). The data log reads from this log, so it sees the
+    # data points appended later, too.
+    def data_log(self, graphs):
+        return [(TelemetrySeries(self, vertical, horizontal), vertical_label, horizontal_label)
+                for vertical, horizontal, vertical_label, horizontal_label in graphs]
+
+# The (vertical, horizontal) data points of a graph, like the lists of tuples
+# in a data_log, with NaN back as None.
+class TelemetrySeries:
+    def __init__(self, log, vertical, horizontal):
+        self.log = log
+        self.vertical, self.horizontal = vertical, horizontal
+
+    def __len__(self):
+        return len(self.log)
+
+    def __getitem__(self, i):
+        vertical, horizontal = self.log.columns[self.vertical][i], self.log.columns[self.horizontal][i]
+        return (None if math.isnan(vertical) else vertical, None if math.isnan(horizontal) else horizontal)
+
+    def __iter__(self):
+        for vertical, horizontal in zip(self.log.columns[self.vertical], self.log.columns[self.horizontal]):
+            yield (None if vertical != vertical else vertical, None if horizontal != horizontal else horizontal)
+
+# An archive of the telemetry of many runs, e.g. of a parameter sweep, in one
+# file that runs are appended to. Every run is a header with what the run was
+# followed by its channels, each a column of little-endian float64 values:
+#
+#   RECORD_HEADER: magic, number of channels, number of data points, time
+#     step, lap time (NaN if it didn't finish), race, driver hash
+#   CHANNEL_NAME for each channel
+#   the values of the first channel, then of the second one, and so on.
+#
+# Reading an archive maps it into memory, and the channels of the runs are
+# slices of that memory, so nothing is read until it's used.
+ARCHIVE_MAGIC = b"SCRTELE1"
+RECORD_HEADER = struct.Struct("<8sIIdd32s64s")
+CHANNEL_NAME = struct.Struct("<32s")
+
+# The same for the same source code of the driver.
+def calculate_driver_hash(driver_algorithm):
+    try:
+        source = inspect.getsource(driver_algorithm).encode()
+    except (OSError, TypeError):
+        source = driver_algorithm.__code__.co_code
+    return hashlib.sha256(source).hexdigest()
+
+# Appends the telemetry of a run to the archive, creating it if needed.
+def append_to_archive(filename, log, race, driver_hash, time_step, lap_time):
+    if any(len(name.encode()) > 32 for name in [race] + log.channels):
+        raise Exception(f"The race and the channel names can be at most 32 bytes long: {[race] + log.channels}")
+    header = RECORD_HEADER.pack(ARCHIVE_MAGIC, len(log.channels), len(log), time_step,
+                                math.nan if lap_time is None else lap_time, race.encode(), driver_hash.encode())
+    with open(filename, "ab") as f:
+        f.write(header)
+        for name in log.channels:
+            f.write(CHANNEL_NAME.pack(name.encode()))
+        for name in log.channels:
+            column = log.columns[name]
+            if sys.byteorder != "little":
+                column = array.array("d", column)
+                column.byteswap()
+            f.write(column.tobytes())
+
+class TelemetryArchive:
+    def __init__(self, filename):
+        self.file = open(filename, "rb")
+        self.runs = []
+        size = os.fstat(self.file.fileno()).st_size
+        if size == 0:
+            # Can't map an empty file.
+            self.memory = None
+            return
+        self.memory = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        # The index of the runs: where each one starts.
+        offset = 0
+        try:
+            while offset < size:
+                run = ArchivedRun(self.memory, offset)
+                self.runs.append(run)
+                offset = run.end
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        for run in self.runs:
+            run.release()
+        self.runs = []
+        if self.memory is not None:
+            self.memory.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# A run in a TelemetryArchive, with the same column, numpy_column and
+# data_log as TelemetryLog. The columns are only valid while the archive is
+# open.
+class ArchivedRun:
+    def __init__(self, memory, offset):
+        if offset + RECORD_HEADER.size > len(memory):
+            raise Exception(f"Truncated telemetry archive record at offset {offset}")
+        magic, num_channels, num_samples, self.time_step, lap_time, race, driver_hash = RECORD_HEADER.unpack_from(memory, offset)
+        if magic != ARCHIVE_MAGIC:
+            raise Exception(f"Not a telemetry archive record at offset {offset}")
+        self.lap_time = None if math.isnan(lap_time) else lap_time
+        self.race = race.rstrip(b"\0").decode()
+        self.driver_hash = driver_hash.rstrip(b"\0").decode()
+        self.num_samples = num_samples
+        names_offset = offset + RECORD_HEADER.size
+        self.channels = [CHANNEL_NAME.unpack_from(memory, names_offset + i * CHANNEL_NAME.size)[0].rstrip(b"\0").decode()
+                         for i in range(num_channels)]
+        self.memory = memory
+        self.data_offset = names_offset + num_channels * CHANNEL_NAME.size
+        self.end = self.data_offset + num_channels * num_samples * 8
+        if self.end > len(memory):
+            raise Exception(f"Truncated telemetry archive record at offset {offset}")
+        # Zero-copy views of the columns; cast("d") reads native float64,
+        # which is what the archive has on little-endian machines.
+        self.view = memoryview(memory)
+        self.columns = {name: self.view[self.channel_offset(name):self.channel_offset(name) + num_samples * 8].cast("d")
+                        for name in self.channels}
+
+    def __len__(self):
+        return self.num_samples
+
+    def release(self):
+        for column in self.columns.values():
+            column.release()
+        self.view.release()
+
+    def channel_offset(self, name):
+        return self.data_offset + self.channels.index(name) * self.num_samples * 8
+
+    def column(self, name):
+        return self.columns[name]
+
+    def numpy_column(self, name):
+        import numpy
+        return numpy.frombuffer(self.memory, dtype = "<f8", count = self.num_samples, offset = self.channel_offset(name))
+
+    def data_log(self, graphs):
+        return [(TelemetrySeries(self, vertical, horizontal), vertical_label, horizontal_label)
+                for vertical, horizontal, vertical_label, horizontal_label in graphs]
+
+#### Self tests
+
+class TestTelemetry(unittest.TestCase):
+
+    def test_every_steps(self):
+        log = TelemetryLog(["t", "distance"], every_steps = 3)
+        kept = [log.append(t, 0) for t in range(10)]
+        self.assertEqual(kept, [True, False, False] * 3 + [True])
+        self.assertEqual(list(log.column("t")), [0, 3, 6, 9])
+
+    def test_every_distance(self):
+        log = TelemetryLog(["t", "distance"], every_distance = 1)
+        for t, distance in enumerate([0, 0.5, 0.9, 1, 1.5, 2.5, 2.6, 3.4, 3.5]):
+            log.append(t, distance)
+        self.assertEqual(list(log.column("distance")), [0, 1, 2.5, 3.5])
+
+        # Both have to hold: standing still keeps only the first data point,
+        # and then only every other step is kept however far the car goes.
+        log = TelemetryLog(["t", "speed", "distance"], every_steps = 2, every_distance = 1)
+        for t in range(10):
+            log.append(t, 0, 0)
+        log.append(10, 1, 1)
+        log.append(11, 1, 2)
+        log.append(12, 1, 3)
+        self.assertEqual(list(log.column("t")), [0, 10, 12])
+
+    def test_max_bytes(self):
+        # Room for 4 data points of 2 channels: every time it's full, every
+        # other data point is dropped and from then on half as many are kept,
+        # so they stay evenly spaced.
+        log = TelemetryLog(["t", "distance"], max_bytes = 64)
+        for t in range(17):
+            log.append(t, t)
+        self.assertEqual(list(log.column("t")), [0, 8, 16])
+        self.assertEqual(list(log.column("distance")), [0, 8, 16])
+        self.assertEqual(log.every_steps, 8)
+        for t in range(17, 33):
+            log.append(t, t)
+        self.assertEqual(list(log.column("t")), [0, 16, 32])
+        self.assertEqual(log.every_steps, 16)
+
+        log = TelemetryLog(["t", "distance"], every_distance = 0.5, max_bytes = 64)
+        for t in range(9):
+            log.append(t, t)
+        self.assertEqual(list(log.column("t")), [0, 4, 8])
+        self.assertEqual((log.every_steps, log.every_distance), (4, 2))
+
+    def test_data_log(self):
+        log = TelemetryLog(["t", "distance", "g"])
+        log.append(0, 0, None)
+        log.append(1, 2, 0.5)
+        data_log = log.data_log([("g", "distance", "G", "distance, m")])
+        series, vertical_label, horizontal_label = data_log[0]
+        self.assertEqual((vertical_label, horizontal_label), ("G", "distance, m"))
+        self.assertTrue(math.isnan(log.column("g")[0]))
+        self.assertEqual(list(series), [(None, 0), (0.5, 2)])
+        self.assertEqual(series[0], (None, 0))
+        # Data points appended later show up, too.
+        log.append(2, 4, None)
+        self.assertEqual(len(series), 3)
+        self.assertEqual(series[-1], (None, 4))
+
+        log.add_channel("speed", [0, 2, 2])
+        self.assertEqual(log.channels, ["t", "distance", "g", "speed"])
+        with self.assertRaises(Exception):
+            log.add_channel("speed", [0, 2])
+
+    def test_archive(self):
+        first = TelemetryLog(["t", "distance", "g"])
+        for t in range(5):
+            first.append(t * 0.1, t * 2.0, None if t == 0 else t / 3)
+        second = TelemetryLog(["t", "speed"])
+        second.append(0, 1.5)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        filename = os.path.join(directory.name, "runs.telemetry")
+        append_to_archive(filename, first, "race_05", "a" * 64, 0.01, 12.345)
+        # A DNF.
+        append_to_archive(filename, second, "race_06", "b" * 64, 0.001, None)
+
+        with open(filename, "rb") as f:
+            data = f.read()
+        first_size = RECORD_HEADER.size + 3 * CHANNEL_NAME.size + 3 * 5 * 8
+        self.assertEqual(RECORD_HEADER.size, 128)
+        self.assertEqual(len(data), first_size + RECORD_HEADER.size + 2 * CHANNEL_NAME.size + 2 * 8)
+        self.assertEqual(RECORD_HEADER.unpack_from(data, 0),
+                         (ARCHIVE_MAGIC, 3, 5, 0.01, 12.345, b"race_05".ljust(32, b"\0"), b"a" * 64))
+        self.assertEqual(data[RECORD_HEADER.size:RECORD_HEADER.size + CHANNEL_NAME.size], b"t".ljust(32, b"\0"))
+        self.assertEqual(data[first_size:first_size + 8], ARCHIVE_MAGIC)
+        self.assertTrue(math.isnan(RECORD_HEADER.unpack_from(data, first_size)[4]))
+        # The values are little-endian float64 whatever the machine.
+        self.assertEqual(data[first_size - 8:first_size], struct.pack("<d", 4 / 3))
+
+        with TelemetryArchive(filename) as archive:
+            self.assertEqual(len(archive.runs), 2)
+            run = archive.runs[0]
+            self.assertEqual((run.race, run.driver_hash, run.time_step, run.lap_time), ("race_05", "a" * 64, 0.01, 12.345))
+            self.assertEqual(run.channels, ["t", "distance", "g"])
+            self.assertEqual(len(run), 5)
+            self.assertEqual(list(run.column("distance")), [0, 2, 4, 6, 8])
+            self.assertEqual(run.end, first_size)
+            series = run.data_log([("g", "t", "G", "t, s")])[0][0]
+            self.assertEqual(list(series), list(first.data_log([("g", "t", "G", "t, s")])[0][0]))
+            self.assertEqual(series[0], (None, 0))
+            run = archive.runs[1]
+            self.assertEqual((run.race, run.driver_hash, run.time_step, run.lap_time), ("race_06", "b" * 64, 0.001, None))
+            self.assertEqual(list(run.column("speed")), [1.5])
+            self.assertEqual(run.end, len(data))
+
+        # An interrupted append, and something that isn't an archive.
+        with open(filename, "wb") as f:
+            f.write(data[:-4])
+        with self.assertRaisesRegex(Exception, f"Truncated telemetry archive record at offset {first_size}"):
+            TelemetryArchive(filename)
+        with open(filename, "wb") as f:
+            f.write(data[:first_size + 10])
+        with self.assertRaisesRegex(Exception, f"Truncated telemetry archive record at offset {first_size}"):
+            TelemetryArchive(filename)
+        with open(filename, "wb") as f:
+            f.write(data[:first_size] + b"x" * RECORD_HEADER.size)
+        with self.assertRaisesRegex(Exception, f"Not a telemetry archive record at offset {first_size}"):
+            TelemetryArchive(filename)
+        with open(filename, "wb") as f:
+            pass
+        with TelemetryArchive(filename) as archive:
+            self.assertEqual(archive.runs, [])
+
+        with self.assertRaises(Exception):
+            append_to_archive(filename, second, "r" * 33, "b" * 64, 0.001, None)
+
+if __name__ == '__main__':
+    unittest.main()